@@ -0,0 +1,184 @@
+import time
+import threading
+
+from rate_limits import is_retryable
+
+# An endpoint failing this many requests in a row is skipped for RETRY_AFTER_SECONDS
+MAX_FAILURES = 3
+RETRY_AFTER_SECONDS = 60
+
+class Endpoint:
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.outstanding = 0
+        self.requests = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+class BalancedStream:
+    """Streamed response that keeps its endpoint acquired until the stream is exhausted, fails or is closed."""
+    def __init__(self, balancer, endpoint, stream):
+        self._balancer = balancer
+        self._endpoint = endpoint
+        self._stream = stream
+        self._released = False
+
+    def _release(self, failed=False):
+        if not self._released:
+            self._released = True
+            self._balancer.release(self._endpoint, failed=failed)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._stream)
+        except StopIteration:
+            self._release()
+            raise
+        except Exception as e:
+            self._release(failed=is_retryable(e))
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self._stream, 'close'):
+                self._stream.close()
+        finally:
+            self._release()
+
+class AsyncBalancedStream(BalancedStream):
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._release()
+            raise
+        except Exception as e:
+            self._release(failed=is_retryable(e))
+            raise
+
+    async def aclose(self):
+        try:
+            if hasattr(self._stream, 'aclose'):
+                await self._stream.aclose()
+        finally:
+            self._release()
+
+class LoadBalancer:
+    """Sends every request to the healthy endpoint with the fewest outstanding requests."""
+    def __init__(self, urls, make_client):
+        self.endpoints = [Endpoint(url, make_client(url)) for url in urls]
+        self.lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        with self.lock:
+            now = time.monotonic()
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or self.endpoints
+            healthy = [endpoint for endpoint in candidates if endpoint.unhealthy_until <= now]
+            # Without healthy endpoints, try the one that is retried first
+            if not healthy:
+                healthy = [min(candidates, key=lambda endpoint: endpoint.unhealthy_until)]
+            # Ties go to the endpoint with fewer requests so far, which spreads sequential requests as well
+            endpoint = min(healthy, key=lambda endpoint: (endpoint.outstanding, endpoint.requests))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, failed=False):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                endpoint.consecutive_failures = 0
+                return
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= MAX_FAILURES:
+                print(f"Endpoint {endpoint.url} is unhealthy, retrying it in {RETRY_AFTER_SECONDS} seconds")
+                endpoint.unhealthy_until = time.monotonic() + RETRY_AFTER_SECONDS
+                endpoint.consecutive_failures = 0
+
+    def call(self, request, stream=False):
+        """Run request(client), a request failing with a connection error, a timeout or a server error is repeated
+        on the other endpoints before the error is raised, other errors are raised right away.
+
+        A streamed response keeps the endpoint acquired until the stream is closed.
+        """
+        tried = []
+        while True:
+            endpoint = self.acquire(exclude=tried)
+            try:
+                result = request(endpoint.client)
+            except Exception as e:
+                if not is_retryable(e):
+                    # Bad requests fail the same way on every endpoint and say nothing about its health
+                    self.release(endpoint)
+                    raise
+                self.release(endpoint, failed=True)
+                tried.append(endpoint)
+                if len(tried) >= len(self.endpoints):
+                    raise
+                continue
+            if stream:
+                return BalancedStream(self, endpoint, result)
+            self.release(endpoint)
+            return result
+
+    async def acall(self, request, stream=False):
+        tried = []
+        while True:
+            endpoint = self.acquire(exclude=tried)
+            try:
+                result = await request(endpoint.client)
+            except Exception as e:
+                if not is_retryable(e):
+                    self.release(endpoint)
+                    raise
+                self.release(endpoint, failed=True)
+                tried.append(endpoint)
+                if len(tried) >= len(self.endpoints):
+                    raise
+                continue
+            if stream:
+                return AsyncBalancedStream(self, endpoint, result)
+            self.release(endpoint)
+            return result
+
+class BalancedClient:
+    """Stands in for one client, e.g. client.chat.completions.create(...) is called on the client chosen by the balancer."""
+    def __init__(self, balancer, is_async=False, path=()):
+        self._balancer = balancer
+        self._is_async = is_async
+        self._path = path
+
+    def __getattr__(self, name):
+        return BalancedClient(self._balancer, self._is_async, self._path + (name,))
+
+    def __call__(self, *args, **kwargs):
+        def request(client):
+            target = client
+            for name in self._path:
+                target = getattr(target, name)
+            return target(*args, **kwargs)
+
+        stream = bool(kwargs.get('stream'))
+        if self._is_async:
+            return self._balancer.acall(request, stream)
+        return self._balancer.call(request, stream)
+
+def balanced_client(api_url, make_client, is_async=False):
+    """Client for a comma-separated list of endpoint URLs, a single URL gives the plain client."""
+    if not api_url:
+        # The client picks its default endpoint
+        return make_client(api_url)
+    urls = [url.strip() for url in api_url.split(',')]
+    if len(urls) == 1:
+        return make_client(urls[0])
+    return BalancedClient(LoadBalancer(urls, make_client), is_async)
@@ -0,0 +1,128 @@
+import time
+import random
+import asyncio
+import threading
+import itertools
+import email.utils
+from types import SimpleNamespace
+
+# Exponential backoff: BACKOFF_BASE_SECONDS * 2^attempt, capped, with the upper half jittered
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+_jitter = random.Random()
+
+def status_code_of(error):
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code
+
+def is_retryable(error):
+    """Rate limits, timeouts, conflicts, server and connection errors are retried, other errors (bad request, authentication, ...) are fatal."""
+    status_code = status_code_of(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES or status_code >= 500
+    # Transport errors of requests, httpx and aiohttp are recognized by the names of their classes and base classes
+    names = [cls.__name__.lower() for cls in type(error).__mro__]
+    return any('timeout' in name or 'connect' in name for name in names)
+
+def retry_after_seconds(error):
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    if headers.get('retry-after-ms'):
+        return float(headers['retry-after-ms']) / 1000
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        # HTTP date
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+
+def backoff_delay(attempt, retry_after=None):
+    cap = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    delay = cap / 2 + _jitter.uniform(0, cap / 2)
+    return max(delay, retry_after or 0.0)
+
+class TokenBucket:
+    """Allows per_minute units per minute with bursts of up to per_minute units."""
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take amount units, returns the number of seconds to wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reservations may go below zero, later callers wait for earlier ones
+            self.available -= min(amount, self.capacity)
+            return max(0.0, -self.available / self.rate)
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, num_tokens):
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(num_tokens))
+        return wait
+
+def estimate_tokens(request):
+    # About four characters per token for the prompt, the completion counts with its maximum length
+    prompt_chars = sum(len(message['content']) for message in request.get('messages', []))
+    return prompt_chars // 4 + request.get('max_tokens', 0)
+
+class RateLimitedClient:
+    """OpenAI client whose chat.completions.create waits for the rate limits and retries retryable errors with backoff."""
+    def __init__(self, client, limiter=None, max_retries=10, is_async=False, on_error=None):
+        self.client = client
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.on_error = on_error
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.acreate if is_async else self.create))
+
+    def _retry_delay(self, error, attempt, started):
+        """Seconds to wait before the next attempt, raises the error if it is fatal or attempts are exhausted."""
+        print(error)
+        if self.on_error is not None:
+            self.on_error(error, started)
+        if not is_retryable(error) or attempt >= self.max_retries:
+            raise error
+        return backoff_delay(attempt, retry_after_seconds(error))
+
+    def create(self, **request):
+        for attempt in itertools.count():
+            if self.limiter is not None:
+                time.sleep(self.limiter.reserve(estimate_tokens(request)))
+            started = time.monotonic()
+            try:
+                return self.client.chat.completions.create(**request)
+            except Exception as e:
+                time.sleep(self._retry_delay(e, attempt, started))
+
+    async def acreate(self, **request):
+        for attempt in itertools.count():
+            if self.limiter is not None:
+                await asyncio.sleep(self.limiter.reserve(estimate_tokens(request)))
+            started = time.monotonic()
+            try:
+                return await self.client.chat.completions.create(**request)
+            except Exception as e:
+                await asyncio.sleep(self._retry_delay(e, attempt, started))
+
+def create_rate_limited_client(args, client, is_async=False, on_error=None):
+    limiter = None
+    if args.requests_per_minute or args.tokens_per_minute:
+        limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+    return RateLimitedClient(client, limiter, args.max_retries, is_async, on_error)
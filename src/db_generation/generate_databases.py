@@ -1,4 +1,5 @@
 import os
+import sys
 import concurrent.futures
 import json
 import logging
@@ -11,11 +12,15 @@ import torch
 import traceback
 from openai import OpenAI
 
+# Modules shared with the evaluation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
 from db_generation_utils import *
+from load_balancer import balanced_client
+from key_concepts import AttachmentConcepts, ScopeConcepts, VagueConcepts
 from validate_databases.validate_scope import *
 from validate_databases.validate_attachment import *
 from validate_databases.validate_vague import *
-from key_concepts import AttachmentConcepts, ScopeConcepts, VagueConcepts
 
 import random
 random.seed(42)
@@ -41,7 +46,7 @@ def _parse_args():
 
     # Model options
     parser.add_argument("--model", type=str, default="openchat_3.5", help="Model name to use")
-    parser.add_argument("--api_url", type=str, help="API URL to connect to")
+    parser.add_argument("--api_url", type=str, help="API URL to connect to, replicas of one model can be given as a comma-separated list")
     parser.add_argument("--num_workers", type=int, default=4, help="Number of worker processes")
 
     parser.add_argument("--temperature", type=float, default=0.6, help="Sampling temperature")
@@ -71,7 +76,7 @@ class DatabaseGenerator:
                  top_k=1.0):
         self.model = model
         self.api_url = api_url
-        self.client = OpenAI(api_key="dockerllmapikey", base_url=args.api_url)  
+        self.client = balanced_client(api_url, lambda url: OpenAI(api_key="dockerllmapikey", base_url=url))
 
         self.db_dir = db_dir
         self.logger = logger
@@ -1,5 +1,6 @@
 import os
 import re
+import sys
 import json
 
 import argparse
@@ -8,7 +9,11 @@ import numpy as np
 import torch
 from openai import OpenAI
 
+# Modules shared with the evaluation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
 from key_concepts import AttachmentConcepts, ScopeConcepts, VagueConcepts
+from load_balancer import balanced_client
 
 import random
 random.seed(42)
@@ -29,7 +34,7 @@ def _parse_args():
     parser.add_argument("--num_attempts", type=int, default=5, help="Number of attempts to try")
     
     parser.add_argument("--model", type=str, default="openchat_3.5", help="Model name to use")
-    parser.add_argument("--api_url", type=str, help="API URL to connect to")
+    parser.add_argument("--api_url", type=str, help="API URL to connect to, replicas of one model can be given as a comma-separated list")
 
     parser.add_argument("--temperature", type=float, default=0.6, help="Sampling temperature")
     parser.add_argument("--top_p", type=float, default=0.95, help="Nucleus sampling probability")
@@ -170,7 +175,7 @@ def generate_items(args, ambig_file):
     with open(os.path.join(args.prompt_file), 'r') as f:
         prompt = f.read()
 
-    client = OpenAI(api_key="dockerllmapikey", base_url=args.api_url)  
+    client = balanced_client(args.api_url, lambda url: OpenAI(api_key="dockerllmapikey", base_url=url))
 
     for domain in domains:
         if domain != 'random':
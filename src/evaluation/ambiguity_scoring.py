@@ -0,0 +1,84 @@
+import math
+
+# Alternatives returned for the answer token, the default maximum of TGI (--max-top-n-tokens) and of VLLM and OpenAI
+TGI_TOP_N_TOKENS = 5
+TOP_LOGPROBS = 20
+ANSWERS = ("yes", "no")
+
+def build_scoring_request(args, prompt):
+    """Request for a single greedy answer token with the log probabilities of the most likely tokens."""
+    if args.use_vllm:
+        return dict(
+                model=args.model_name,
+                prompt=prompt,
+                temperature=0.0,
+                max_tokens=1,
+                logprobs=TOP_LOGPROBS,
+                seed=args.seed)
+    elif args.use_openai:
+        return dict(
+                model=args.model,
+                messages=[{'role': 'user', 'content': prompt}],
+                temperature=0.0,
+                max_tokens=1,
+                logprobs=True,
+                top_logprobs=TOP_LOGPROBS,
+                seed=args.seed)
+    elif args.use_tgi:
+        return dict(prompt=prompt, max_new_tokens=1, do_sample=False, details=True, top_n_tokens=TGI_TOP_N_TOKENS)
+    raise ValueError("Answer tokens are scored only with VLLM, OpenAI and TGI servers or local Transformers models")
+
+def top_logprobs_of(args, response):
+    """(token, log probability) pairs of the most likely answer tokens in a server response."""
+    if args.use_vllm:
+        return list(response.choices[0].logprobs.top_logprobs[0].items())
+    elif args.use_openai:
+        return [(top.token, top.logprob) for top in response.choices[0].logprobs.content[0].top_logprobs]
+    return [(token.text, token.logprob) for token in response.details.top_tokens[0]]
+
+def transformers_top_logprobs(generator, prompt):
+    """(token, log probability) pairs of the most likely next tokens of a local model, from one forward pass over the prompt."""
+    # torch is only needed for local models
+    import torch
+    inputs = generator.tokenizer(prompt, return_tensors='pt').to(generator.model.device)
+    with torch.inference_mode():
+        logits = generator.model(**inputs).logits[0, -1]
+    logprobs, token_ids = torch.log_softmax(logits.float(), dim=-1).topk(TOP_LOGPROBS)
+    return [(generator.tokenizer.decode([token_id]), logprob) for token_id, logprob in zip(token_ids.tolist(), logprobs.tolist())]
+
+def score_answer(top_logprobs):
+    """Answer and score P(yes) / (P(yes) + P(no)) from the most likely answer tokens.
+
+    Variants of an answer (' Yes', 'YES') add up, the score is 0.5 and the answer 'n/a' if neither answer is among the tokens.
+    """
+    probabilities = dict.fromkeys(ANSWERS, 0.0)
+    for token, logprob in top_logprobs:
+        answer = token.strip().lower()
+        if answer in probabilities and logprob is not None:
+            probabilities[answer] += math.exp(logprob)
+
+    total = probabilities['yes'] + probabilities['no']
+    if not total:
+        return {'answer': 'n/a', 'score': 0.5, 'p_yes': 0.0, 'p_no': 0.0}
+    score = probabilities['yes'] / total
+    return {'answer': 'yes' if score > 0.5 else 'no', 'score': score, 'p_yes': probabilities['yes'], 'p_no': probabilities['no']}
+
+def score_ambiguity(args, generator, prompt):
+    if args.use_vllm:
+        response = generator.completions.create(**build_scoring_request(args, prompt))
+    elif args.use_openai:
+        response = generator.chat.completions.create(**build_scoring_request(args, prompt))
+    elif args.use_tgi:
+        response = generator.text_generation(**build_scoring_request(args, prompt))
+    else:
+        return score_answer(transformers_top_logprobs(generator, prompt))
+    return score_answer(top_logprobs_of(args, response))
+
+async def ascore_ambiguity(args, generator, prompt):
+    if args.use_vllm:
+        response = await generator.completions.create(**build_scoring_request(args, prompt))
+    elif args.use_openai:
+        response = await generator.chat.completions.create(**build_scoring_request(args, prompt))
+    else:
+        response = await generator.text_generation(**build_scoring_request(args, prompt))
+    return score_answer(top_logprobs_of(args, response))
@@ -0,0 +1,73 @@
+import asyncio
+
+from ambiguity_scoring import ascore_ambiguity
+from evaluation_utils import build_request, parse_response
+from load_balancer import balanced_client
+from rate_limits import create_rate_limited_client
+from vllm_batching import batched_completions_client
+
+def create_async_generator(args, on_error=None):
+    if args.use_tgi:
+        from huggingface_hub import AsyncInferenceClient
+        return balanced_client(args.api_url, lambda url: AsyncInferenceClient(model=url), is_async=True)
+    elif args.use_vllm:
+        from openai import AsyncOpenAI
+        client = balanced_client(args.api_url, lambda url: AsyncOpenAI(base_url=url, api_key=args.api_key), is_async=True)
+        return batched_completions_client(args, client, is_async=True)
+    elif args.use_openchat_api:
+        from openai import AsyncOpenAI
+        return balanced_client(args.api_url, lambda url: AsyncOpenAI(base_url=url, api_key=args.api_key), is_async=True)
+    elif args.use_openai:
+        from openai import AsyncOpenAI
+        return create_rate_limited_client(args, AsyncOpenAI(api_key=args.api_key, max_retries=0), is_async=True, on_error=on_error)
+    raise ValueError("Asynchronous generation is supported only for TGI, VLLM, OpenChat and OpenAI servers")
+
+async def agenerate(args, generator, prompt, early_stopper=None):
+    if args.logprob_detection:
+        return await ascore_ambiguity(args, generator, prompt)
+    request = build_request(args, prompt)
+    if args.use_vllm:
+        response = await generator.completions.create(**request)
+    elif args.use_openai or args.use_openchat_api:
+        response = await generator.chat.completions.create(**request)
+    elif early_stopper is not None:
+        response = await early_stopper.agenerate(generator, request)
+    else:
+        response = await generator.text_generation(**request)
+    return parse_response(args, response)
+
+async def _generate_all(args, requests, max_concurrency, cache=None, concurrency=None, early_stopper=None):
+    generator = create_async_generator(args, concurrency.report_error if concurrency is not None else None)
+
+    # One queue shared by all workers: the number of workers bounds the number of requests in flight
+    queue = asyncio.Queue()
+    for key, prompt in requests:
+        queue.put_nowait((key, prompt))
+
+    outputs = {}
+    async def worker():
+        while not queue.empty():
+            key, prompt = queue.get_nowait()
+            if cache is not None:
+                cache_key = cache.make_key(args, prompt)
+                cached_outputs = cache.get(cache_key)
+                if cached_outputs is not None:
+                    outputs[key] = cached_outputs
+                    continue
+
+            if concurrency is None:
+                outputs[key] = await agenerate(args, generator, prompt, early_stopper)
+            else:
+                async with concurrency.aslot():
+                    outputs[key] = await agenerate(args, generator, prompt, early_stopper)
+            if cache is not None:
+                cache.put(cache_key, outputs[key])
+
+    await asyncio.gather(*(worker() for _ in range(min(max_concurrency, len(requests)))))
+    return outputs
+
+def generate_all(args, requests, cache=None, concurrency=None, early_stopper=None):
+    """Generate outputs for a list of (key, prompt) pairs, returns a dictionary key -> outputs."""
+    if not requests:
+        return {}
+    return asyncio.run(_generate_all(args, requests, args.max_concurrency, cache, concurrency, early_stopper))
@@ -0,0 +1,68 @@
+import torch
+
+# Same generation length as the Transformers pipelines in evaluate_model_tgi.create_generator
+MAX_NEW_TOKENS = 500
+
+class BatchedGenerator:
+    """Local Transformers model generating for many prompts at once.
+
+    Prompts are sorted by token length and cut into batches of batch_size, so that prompts of one batch
+    need little padding. Outputs have the format of the Transformers pipelines: prompt followed by the completion.
+    """
+    def __init__(self, args, model, tokenizer):
+        self.args = args
+        self.model = model
+        self.tokenizer = tokenizer
+        self.tokenizer.padding_side = 'left'
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+    def generation_kwargs(self):
+        if self.args.use_transformers_beam:
+            return dict(num_beams=5, num_return_sequences=self.args.num_return_sequences, do_sample=False, max_new_tokens=MAX_NEW_TOKENS)
+        return dict(do_sample=True, temperature=self.args.temperature, top_p=self.args.top_p, max_new_tokens=MAX_NEW_TOKENS)
+
+    def buckets(self, requests):
+        if not requests:
+            return
+        lengths = [len(input_ids) for input_ids in self.tokenizer([prompt for _, prompt in requests])['input_ids']]
+        order = sorted(range(len(requests)), key=lambda i: lengths[i])
+        for start in range(0, len(order), self.args.batch_size):
+            yield [requests[i] for i in order[start:start + self.args.batch_size]]
+
+    def decode(self, prompt, input_ids, sequence):
+        # As the pipelines with return_full_text: the decoded prompt is replaced by the original one
+        prompt_length = len(self.tokenizer.decode(input_ids, skip_special_tokens=True, clean_up_tokenization_spaces=True))
+        text = self.tokenizer.decode(sequence, skip_special_tokens=True, clean_up_tokenization_spaces=True)
+        return prompt + text[prompt_length:]
+
+    @torch.inference_mode()
+    def generate_batch(self, prompts):
+        inputs = self.tokenizer(prompts, return_tensors='pt', padding=True).to(self.model.device)
+        sequences = self.model.generate(**inputs, pad_token_id=self.tokenizer.pad_token_id, **self.generation_kwargs())
+        num_sequences = len(sequences) // len(prompts)
+
+        outputs = []
+        for i, prompt in enumerate(prompts):
+            texts = [self.decode(prompt, inputs['input_ids'][i], sequence) for sequence in sequences[i * num_sequences:(i + 1) * num_sequences]]
+            outputs.append(texts if self.args.use_transformers_beam and self.args.num_return_sequences > 1 else texts[0])
+        return outputs
+
+    def generate_all(self, requests, cache=None):
+        """Generate outputs for a list of (key, prompt) pairs, returns a dictionary key -> outputs."""
+        outputs = {}
+        missing = []
+        for key, prompt in requests:
+            cached_outputs = cache.get(cache.make_key(self.args, prompt)) if cache is not None else None
+            if cached_outputs is not None:
+                outputs[key] = cached_outputs
+            else:
+                missing.append((key, prompt))
+
+        for batch in self.buckets(missing):
+            prompts = [prompt for _, prompt in batch]
+            for (key, prompt), batch_outputs in zip(batch, self.generate_batch(prompts)):
+                outputs[key] = batch_outputs
+                if cache is not None:
+                    cache.put(cache.make_key(self.args, prompt), batch_outputs)
+        return outputs
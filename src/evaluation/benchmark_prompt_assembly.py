@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+
+# Modules shared with the database generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
+from eval import parse_args
+from evaluation_utils import Dataset
+from format_prompts import format_prompt, write_icl_prompt, PromptAssembler
+
+def benchmark(args, prompt_template, rows, tokenizer=None):
+    """Per-prompt cost of format_prompt and PromptAssembler for a list of (db_dump, question) pairs."""
+    started = time.perf_counter()
+    expected = [format_prompt(args, prompt_template, db_dump, question, tokenizer) for db_dump, question in rows]
+    format_prompt_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    assembler = PromptAssembler(args, prompt_template, tokenizer)
+    prompts = [assembler.format(db_dump, question) for db_dump, question in rows]
+    assembler_seconds = time.perf_counter() - started
+
+    assert prompts == expected, "PromptAssembler gives different prompts than format_prompt"
+    return format_prompt_seconds / len(rows), assembler_seconds / len(rows)
+
+if __name__ == "__main__":
+    # Takes the same arguments as evaluation, only the prompt and dataset options are used
+    args = parse_args()
+
+    tokenizer = None
+    if args.use_tgi:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name, cache_dir=args.transformers_cache)
+
+    dataset = Dataset(args.croissant_file, args.dataset_cache_dir)
+    with open(args.prompt_file, 'r') as f:
+        prompt_template = f.read()
+    if args.icl_pairs:
+        write_icl_prompt(args, prompt_template, dataset.df_few_shot_examples)
+
+    rows = list(zip(dataset.df_test['db_dump'], dataset.df_test['question']))
+    format_prompt_cost, assembler_cost = benchmark(args, prompt_template, rows, tokenizer)
+    print(f"{len(rows)} prompts, {dataset.df_test['db_file'].nunique()} databases")
+    print(f"format_prompt:   {format_prompt_cost * 1e6:.1f} us per prompt")
+    print(f"PromptAssembler: {assembler_cost * 1e6:.1f} us per prompt")
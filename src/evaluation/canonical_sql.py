@@ -0,0 +1,149 @@
+import re
+
+from sqlparse import lexer, tokens as T
+
+# Unquoted identifiers, SQLite compares them ignoring ASCII case
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_$]*')
+_QUOTED_IDENTIFIER = re.compile(r'^(?:"(.*)"|`(.*)`|\[(.*)\])$', re.DOTALL)
+_ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+_SYMBOL_COMPARISONS = {'=', '==', '!=', '<>', '<', '>', '<=', '>='}
+# Tokens whose case and inner whitespace carry no meaning, lowercase like identifiers as sqlparse lexes
+# some words (COUNT, NAME) as keywords or as names depending on what follows
+_CASE_INSENSITIVE_TYPES = (T.Keyword, T.Name.Builtin, T.Operator.Comparison)
+# Single-character tokens of SQLite, whitespace around them can be dropped
+_SEPARATORS = "(),"
+
+def _is_identifier(ttype, value):
+    return ttype is T.Name and _IDENTIFIER.fullmatch(value) is not None
+
+def _significant_tokens(query):
+    """(token type, value, preceded by whitespace) of query without whitespace, comments and the final semicolon.
+
+    None if dropping them could change how SQLite runs the query.
+    """
+    tokens = []
+    space = False
+    semicolon_seen = False
+    for ttype, value in lexer.tokenize(query):
+        if ttype in T.Whitespace or ttype in T.Newline:
+            space = True
+            continue
+        # Only one semicolon followed by whitespace can go: Python refuses 'a;;' and 'a; -- c' fails as a subquery
+        if semicolon_seen or ttype in T.Error:
+            return None
+        if ttype is T.Punctuation and value == ';':
+            semicolon_seen = True
+            continue
+        if ttype in T.Comment:
+            space = True
+            continue
+        if any(ttype in case_insensitive for case_insensitive in _CASE_INSENSITIVE_TYPES):
+            value = ' '.join(value.split()).translate(_ASCII_LOWER)
+        elif _is_identifier(ttype, value):
+            value = value.translate(_ASCII_LOWER)
+        tokens.append((ttype, value, space))
+        space = False
+    return tokens
+
+def _alias_definitions(tokens):
+    """Indexes of the tokens naming tables or subqueries after FROM and JOIN, and whether AS precedes them."""
+    definitions = {}
+    # Position in a FROM clause for every open parenthesis level: 'table' expects a table, 'after_table' an alias,
+    # 'alias' an alias after AS, 'from' a comma or JOIN, 'subquery' waits for the parenthesis to close
+    states = ['other']
+    for i, (ttype, value, _) in enumerate(tokens):
+        state = states[-1]
+        if value == '(' and ttype is T.Punctuation:
+            states[-1] = 'subquery' if state == 'table' else state
+            states.append('other')
+        elif value == ')' and ttype is T.Punctuation:
+            if len(states) > 1:
+                states.pop()
+            if states[-1] == 'subquery':
+                states[-1] = 'after_table'
+        elif ttype in T.Keyword and (value == 'from' or value.endswith('join')):
+            states[-1] = 'table'
+        elif value == ',' and state in ('after_table', 'from'):
+            states[-1] = 'table'
+        elif value == '.' and state == 'after_table':
+            # Schema name before the table name
+            states[-1] = 'table'
+        elif value == 'as' and state == 'after_table':
+            states[-1] = 'alias'
+        elif _is_identifier(ttype, value) and state in ('table', 'after_table', 'alias'):
+            if state == 'table':
+                states[-1] = 'after_table'
+            else:
+                definitions[i] = state == 'alias'
+                states[-1] = 'from'
+        else:
+            states[-1] = 'other'
+    return definitions
+
+def _unquoted(value):
+    m = _QUOTED_IDENTIFIER.match(value)
+    if m is None:
+        return value.translate(_ASCII_LOWER)
+    return next(group for group in m.groups() if group is not None).translate(_ASCII_LOWER)
+
+def _rename_aliases(tokens):
+    """Tokens with table aliases named t1, t2, ... in order of definition, always after as.
+
+    Unchanged if an alias is used other than as a qualifier or if a new name is taken by another identifier.
+    """
+    definitions = _alias_definitions(tokens)
+    aliases = {}
+    for i in definitions:
+        aliases.setdefault(tokens[i][1], f"t{len(aliases) + 1}")
+    if not aliases:
+        return tokens
+
+    for i, (ttype, value, _) in enumerate(tokens):
+        if i in definitions:
+            continue
+        if _is_identifier(ttype, value) and value in aliases:
+            qualifier = i + 1 < len(tokens) and tokens[i + 1][1] == '.'
+            if not qualifier:
+                return tokens
+        elif ttype in T.Name or ttype in T.String.Symbol or ttype in T.Keyword:
+            name = _unquoted(value)
+            if name in aliases or name in aliases.values():
+                return tokens
+
+    renamed = []
+    for i, (ttype, value, space) in enumerate(tokens):
+        if _is_identifier(ttype, value) and value in aliases:
+            if i in definitions and not definitions[i]:
+                renamed.append((T.Keyword, 'as', True))
+            renamed.append((ttype, aliases[value], space or i in definitions))
+        else:
+            renamed.append((ttype, value, space))
+    return renamed
+
+def _needs_space(left, right):
+    if left[-1] in _SEPARATORS or right[0] in _SEPARATORS:
+        return False
+    # 'a = b' and 'a=b' are the same, '= -1' is kept as '=-' could lex differently
+    if left in _SYMBOL_COMPARISONS:
+        return not (right[0].isalnum() or right[0] in "_'\"`[")
+    if right in _SYMBOL_COMPARISONS:
+        return not (left[-1].isalnum() or left[-1] in "_'\"`]")
+    return True
+
+def canonicalize_query(query):
+    """Text that is the same for queries that differ only in whitespace, comments, keyword and identifier case,
+    a final semicolon or table alias names, and that SQLite runs with the same result as query.
+
+    Queries that do not lex cleanly are returned unchanged.
+    """
+    tokens = _significant_tokens(query)
+    if not tokens:
+        return query
+    tokens = _rename_aliases(tokens)
+
+    parts = [tokens[0][1]]
+    for (_, left, _), (_, right, space) in zip(tokens, tokens[1:]):
+        if space and _needs_space(left, right):
+            parts.append(' ')
+        parts.append(right)
+    return ''.join(parts)
@@ -0,0 +1,83 @@
+import json
+import time
+import sqlite3
+import argparse
+
+import sqlparse
+
+import output_parsers
+from sql_splitter import split_statements, IncrementalSplitter
+
+PARSERS = [
+    output_parsers.parse_statements_openchat,
+    output_parsers.parse_statements_mistral,
+    output_parsers.parse_statements_mixtral,
+    output_parsers.parse_statements_llama,
+    output_parsers.parse_statements_codellama,
+    output_parsers.parse_single_statement,
+]
+
+# Inputs that were once split differently from sqlparse, always checked and fed one character at a time
+REGRESSION_TEXTS = [
+    # 'GO' is a keyword ending a statement until the dot makes it a name
+    'GO\n\n.";x',
+]
+
+def read_completions(cache_file):
+    conn = sqlite3.connect(cache_file)
+    for (outputs,) in conn.execute("SELECT outputs FROM completions"):
+        outputs = json.loads(outputs)
+        # VLLM stores several choices per prompt
+        yield from outputs if isinstance(outputs, list) else [outputs]
+    conn.close()
+
+def split_incrementally(text, chunk_size):
+    splitter = IncrementalSplitter()
+    for start in range(0, len(text), chunk_size):
+        splitter.feed(text[start:start + chunk_size])
+        splitter.statements()
+    return splitter.statements()
+
+def parse_with(split, parser, text):
+    output_parsers.split_statements = split
+    try:
+        return parser(text)
+    finally:
+        output_parsers.split_statements = split_statements
+
+def check(completions, chunk_size):
+    """Number of completions for which split_statements, IncrementalSplitter or a parser differ from sqlparse."""
+    mismatches = 0
+    sqlparse_seconds, fast_seconds = 0.0, 0.0
+    for text in completions:
+        started = time.perf_counter()
+        expected = sqlparse.split(text)
+        sqlparse_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        result = split_statements(text)
+        fast_seconds += time.perf_counter() - started
+
+        same = result == expected and split_incrementally(text, chunk_size) == expected
+        same = same and all(parse_with(sqlparse.split, parser, text) == parser(text) for parser in PARSERS)
+        if not same:
+            mismatches += 1
+            print(f"Mismatch: {text!r}")
+    return mismatches, sqlparse_seconds, fast_seconds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the statement splitter gives the results of sqlparse on recorded completions.")
+    parser.add_argument("completion_caches", nargs="*", help="SQLite files written with --completion_cache")
+    parser.add_argument("--chunk_size", type=int, default=4, help="Characters fed at once to the incremental splitter")
+    args = parser.parse_args()
+
+    regression_mismatches, _, _ = check(REGRESSION_TEXTS, 1)
+    print(f"{len(REGRESSION_TEXTS)} regression texts, {regression_mismatches} mismatches")
+
+    completions = [text for cache_file in args.completion_caches for text in read_completions(cache_file)]
+    mismatches, sqlparse_seconds, fast_seconds = check(completions, args.chunk_size)
+    mismatches += regression_mismatches
+    print(f"{len(completions)} completions, {mismatches} mismatches")
+    print(f"sqlparse.split: {sqlparse_seconds:.3f} s, split_statements: {fast_seconds:.3f} s")
+    if mismatches:
+        raise SystemExit(1)
@@ -0,0 +1,59 @@
+import json
+import hashlib
+import sqlite3
+import threading
+
+def backend_name(args):
+    for backend in ['vllm', 'openai', 'openchat_api', 'tgi', 'transformers_beam']:
+        if getattr(args, f"use_{backend}", False):
+            return backend
+    return 'transformers'
+
+class CompletionCache:
+    """Completions stored in a single SQLite file, keyed on the prompt and all generation parameters."""
+    def __init__(self, cache_file):
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, outputs TEXT NOT NULL)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, args, prompt):
+        fields = {
+            'backend': backend_name(args),
+            'model_name': args.model_name,
+            'prompt': hashlib.sha256(prompt.encode('utf-8')).hexdigest(),
+            'temperature': args.temperature,
+            'top_p': args.top_p,
+            'top_k': args.top_k,
+            'repetition_penalty': args.repetition_penalty,
+            'max_new_tokens': args.max_new_tokens,
+            'num_return_sequences': args.num_return_sequences,
+            'seed': args.seed,
+        }
+        # Added only when set, so that keys of completions cached before stay the same
+        if args.stream_early_stop:
+            # Early-stopped completions are truncated, they must not replay for runs without early stop
+            fields['early_stop_patience'] = args.early_stop_patience
+        if args.logprob_detection:
+            fields['logprob_detection'] = True
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT outputs FROM completions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key, outputs):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO completions (key, outputs) VALUES (?, ?)", (key, json.dumps(outputs)))
+            # Commit every completion so that a crashed run can be replayed up to the crash
+            self.conn.commit()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,125 @@
+import time
+import asyncio
+import threading
+import contextlib
+
+from rate_limits import status_code_of
+
+def is_overload_error(error):
+    """Rate limits (429), server errors (5xx) and timeouts signal an overloaded server."""
+    status_code = status_code_of(error)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return isinstance(error, TimeoutError) or 'timeout' in type(error).__name__.lower()
+
+class AdaptiveConcurrency:
+    """AIMD limit on the number of generation requests in flight.
+
+    Every successful request adds 1 / limit to the limit, so the limit grows by one per round of requests
+    while latency stays within latency_factor of its moving average. Overload errors and latency spikes halve it,
+    at most once per round: requests started before the last decrease do not decrease it again.
+    """
+    def __init__(self, initial=6, minimum=1, maximum=64, latency_factor=2.0, backoff=0.5, warmup=5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_factor = latency_factor
+        self.backoff = backoff
+        self.warmup = warmup
+
+        self.in_flight = 0
+        self.average_latency = None
+        self.num_latencies = 0
+        self.last_decrease = 0.0
+        self.start_time = time.monotonic()
+        # (seconds since start, limit, reason) for every change of the integer limit
+        self.history = [(0.0, int(self.limit), 'initial')]
+
+        self.condition = threading.Condition()
+        self.async_condition = None
+
+    def _has_slot(self):
+        return self.in_flight < int(self.limit)
+
+    def _record(self, reason):
+        if int(self.limit) != self.history[-1][1]:
+            self.history.append((time.monotonic() - self.start_time, int(self.limit), reason))
+
+    def _decrease(self, started, reason):
+        if started < self.last_decrease:
+            return
+        self.limit = max(self.minimum, self.limit * self.backoff)
+        self.last_decrease = time.monotonic()
+        self._record(reason)
+
+    def _finish(self, started, failed=False, overloaded=False):
+        latency = time.monotonic() - started
+        self.in_flight -= 1
+        if overloaded:
+            self._decrease(started, 'overload')
+            return
+        # Other failures (bad requests, parse errors) say nothing about the load of the server
+        if failed:
+            return
+
+        self.num_latencies += 1
+        if self.num_latencies > self.warmup and latency > self.latency_factor * self.average_latency:
+            self._decrease(started, 'latency')
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._record('increase')
+        self.average_latency = latency if self.average_latency is None else 0.9 * self.average_latency + 0.1 * latency
+
+    def report_error(self, error, started):
+        """Report a failed attempt started at started (time.monotonic) inside a request that is retried, e.g. a rate limit."""
+        if is_overload_error(error):
+            with self.condition:
+                self._decrease(started, 'overload')
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self.condition:
+            self.condition.wait_for(self._has_slot)
+            self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            with self.condition:
+                self._finish(started, failed=True, overloaded=is_overload_error(e))
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self._finish(started)
+            self.condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        # Used from a single event loop, the state is shared with slot() under self.condition
+        if self.async_condition is None:
+            self.async_condition = asyncio.Condition()
+        async with self.async_condition:
+            await self.async_condition.wait_for(self._has_slot)
+            with self.condition:
+                self.in_flight += 1
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            with self.condition:
+                self._finish(started, failed=True, overloaded=is_overload_error(e))
+            raise
+        else:
+            with self.condition:
+                self._finish(started)
+        finally:
+            async with self.async_condition:
+                self.async_condition.notify_all()
+
+    def stats(self):
+        limits = [limit for _, limit, _ in self.history]
+        return {
+            'final_limit': int(self.limit),
+            'max_limit': max(limits),
+            'decreases': sum(reason in ['overload', 'latency'] for _, _, reason in self.history)
+        }
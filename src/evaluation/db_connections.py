@@ -0,0 +1,112 @@
+import time
+import sqlite3
+import contextlib
+import pathlib
+import threading
+from collections import OrderedDict
+
+from exceptions import QueryBudgetExceededError
+
+# Connections are not shared between threads, every thread keeps its own small LRU pool
+MAX_CONNECTIONS_PER_THREAD = 16
+
+# Number of SQLite VM instructions between deadline checks and rows per fetchmany call
+PROGRESS_HANDLER_STEPS = 10000
+FETCH_SIZE = 1000
+
+_local = threading.local()
+
+# Copy every database into memory once per thread instead of reading it from disk
+use_in_memory_snapshots = False
+
+def configure(in_memory=False):
+    global use_in_memory_snapshots
+    use_in_memory_snapshots = in_memory
+
+# Connections are in autocommit mode: with implicit transactions, the first temporary table of an in-database
+# comparison opens a transaction that an interrupted query later rolls back, with the tables of earlier queries
+def open_read_only(db_file):
+    uri = pathlib.Path(db_file).absolute().as_uri() + "?mode=ro&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, isolation_level=None)
+    conn.execute("PRAGMA mmap_size = 268435456")
+    conn.execute("PRAGMA cache_size = -65536")
+    return conn
+
+def open_in_memory_snapshot(db_file):
+    disk_conn = open_read_only(db_file)
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    disk_conn.backup(conn)
+    disk_conn.close()
+    # The snapshot is writable, protect it from predicted queries that modify data
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+def get_connection(db_file):
+    """Read-only connection to db_file owned by the calling thread, opened on first use."""
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = OrderedDict()
+
+    if db_file in connections:
+        connections.move_to_end(db_file)
+        return connections[db_file]
+
+    if len(connections) >= MAX_CONNECTIONS_PER_THREAD:
+        _, oldest_conn = connections.popitem(last=False)
+        oldest_conn.close()
+
+    if use_in_memory_snapshots:
+        conn = connections[db_file] = open_in_memory_snapshot(db_file)
+    else:
+        conn = connections[db_file] = open_read_only(db_file)
+    return conn
+
+@contextlib.contextmanager
+def execution_budget(conn, query, timeout=None):
+    """Interrupt statements executed inside the block after timeout seconds and raise QueryBudgetExceededError."""
+    if not timeout:
+        yield
+        return
+
+    deadline = time.monotonic() + timeout
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_HANDLER_STEPS)
+    try:
+        yield
+    except sqlite3.OperationalError as e:
+        if time.monotonic() > deadline and "interrupted" in str(e):
+            raise QueryBudgetExceededError(query, 'timeout', timeout)
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+
+@contextlib.contextmanager
+def temp_tables_allowed(conn):
+    """In-memory snapshots are query_only, which also forbids temporary tables."""
+    query_only = conn.execute("PRAGMA query_only").fetchone()[0]
+    if query_only:
+        conn.execute("PRAGMA query_only = OFF")
+    try:
+        yield
+    finally:
+        if query_only:
+            conn.execute("PRAGMA query_only = ON")
+
+def iter_query_batches(cursor, query, timeout=None, max_rows=None):
+    """Execute a query and yield its result in batches, raising QueryBudgetExceededError after timeout seconds or max_rows rows."""
+    with execution_budget(cursor.connection, query, timeout):
+        cursor.execute(query)
+        num_rows = 0
+        while True:
+            batch = cursor.fetchmany(FETCH_SIZE)
+            if not batch:
+                return
+            num_rows += len(batch)
+            if max_rows is not None and num_rows > max_rows:
+                raise QueryBudgetExceededError(query, 'max_rows', max_rows)
+            yield batch
+
+def execute_query(cursor, query, timeout=None, max_rows=None):
+    rows = []
+    for batch in iter_query_batches(cursor, query, timeout, max_rows):
+        rows += batch
+    return rows
@@ -1,15 +1,24 @@
 import os
 import json
 import random
+import hashlib
 import argparse
 
 import concurrent.futures
 
 import numpy as np
 
-from evaluation_utils import Dataset, EvaluatorConfig, generate
-from format_prompts import write_icl_prompt, format_prompt
-from metrics import evaluate_predicted_statements
+from evaluation_utils import Dataset, EvaluatorConfig, generate, parse_outputs, score_statements
+from format_prompts import write_icl_prompt, PromptAssembler
+from async_generation import generate_all
+from gold_index import GoldIndex
+from metrics import roc_auc
+from pipeline import run_pipeline
+from prefix_scheduler import schedule_by_prefix
+from prompt_budget import load_token_counter, apply_token_budget
+from rate_limits import RateLimitedClient
+from results_stream import ResultsStream, read_results_stream, completed_keys
+import db_connections
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Evaluate a model on AMBROSIA.")
@@ -18,6 +27,7 @@ def parse_args():
 
     parser.add_argument("--prompt_file", type=str, default="src/prompts/evaluation/prompt", help="File with the prompt")
     parser.add_argument("--croissant_file", type=str, default="data/ambrosia_croissant.json", help="Dataset in croissant format")
+    parser.add_argument("--dataset_cache_dir", type=str, help="Directory for the parsed dataset, reused while the croissant file does not change")
     parser.add_argument("--experiment_name", type=str, default="", help="Optional name of experiment")
 
     parser.add_argument("--icl_pairs", type=int, default=0, help="Number of ICL examples")
@@ -29,6 +39,7 @@ def parse_args():
     parser.add_argument("--model_name", type=str, help="Full model name (as in HuggingFace Hub)")
 
     parser.add_argument("--ambig_detection", action="store_true", help="Evaluate detection of ambiguity")
+    parser.add_argument("--logprob_detection", action="store_true", help="With --ambig_detection, request one answer token and score questions by the probabilities of yes and no")
 
     parser.add_argument("--use_openchat_api", action="store_true", help="Use OpenChat server")
     parser.add_argument("--use_tgi", action="store_true", help="Use TGI server")
@@ -36,7 +47,36 @@ def parse_args():
     parser.add_argument("--use_vllm", action="store_true", help="Use VLLM")
     parser.add_argument("--use_transformers_beam", action="store_true", help="Use Transformers for beam search")
 
-    parser.add_argument("--api_url", type=str, help="API URL to connect to")
+    parser.add_argument("--async_generation", action="store_true", help="Send prompts for all questions through one asynchronous queue before scoring")
+    parser.add_argument("--vllm_batch_size", type=int, default=1, help="Coalesce up to this many concurrent prompts into one VLLM completions request")
+    parser.add_argument("--batch_size", type=int, help="Generate with the local Transformers model in batches of prompts of similar length")
+    parser.add_argument("--max_concurrency", type=int, default=32, help="Maximum number of requests in flight with --async_generation or --adaptive_concurrency")
+
+    parser.add_argument("--gold_index", type=str, default="", help="Precomputed gold query results (see gold_index.py)")
+    parser.add_argument("--in_memory_db", action="store_true", help="Load every database into memory once per worker for executing queries")
+    parser.add_argument("--query_timeout", type=float, help="Time limit in seconds for executing one predicted query")
+    parser.add_argument("--max_result_rows", type=int, help="Maximum number of rows fetched for one predicted query")
+    parser.add_argument("--in_db_comparison", action="store_true", help="Compare execution results inside SQLite instead of fetching them")
+    parser.add_argument("--adaptive_concurrency", action="store_true", help="Adapt the number of generation requests in flight (up to --max_concurrency) to server latency and errors")
+    parser.add_argument("--initial_concurrency", type=int, default=6, help="Number of generation requests in flight at the start with --adaptive_concurrency")
+    parser.add_argument("--requests_per_minute", type=int, help="Request rate limit for OpenAI")
+    parser.add_argument("--tokens_per_minute", type=int, help="Token rate limit for OpenAI, prompts are estimated at four characters per token")
+    parser.add_argument("--max_retries", type=int, default=10, help="Retries of rate limited, timed out or failed OpenAI requests before giving up")
+    parser.add_argument("--stream_early_stop", action="store_true", help="Stream TGI completions and stop them once the parsed queries no longer change")
+    parser.add_argument("--early_stop_patience", type=int, default=64, help="Tokens without a change of the parsed queries before a streamed completion is stopped")
+    parser.add_argument("--completion_cache", type=str, default="", help="SQLite file for caching completions between runs")
+
+    parser.add_argument("--dump_token_budget", type=int, help="Keep at most this many tokens of every database dump by dropping INSERT rows")
+    parser.add_argument("--max_prompt_tokens", type=int, help="Skip questions whose prompt has more tokens, checked before generation")
+    parser.add_argument("--prefix_scheduling", action="store_true", help="Send prompts sharing a prefix (ICL block and database dump) to the server back to back")
+    parser.add_argument("--resume", action="store_true", help="Skip questions already stored in the results stream of the same experiment")
+    parser.add_argument("--shard_index", type=int, default=0, help="Evaluate only this shard of the test questions")
+    parser.add_argument("--num_shards", type=int, default=1, help="Number of shards, merge their results with merge_shards.py")
+    parser.add_argument("--pipeline", action="store_true", help="Overlap generation, parsing and execution of queries in separate stages")
+    parser.add_argument("--num_generation_workers", type=int, default=6, help="Number of generation threads with --pipeline")
+    parser.add_argument("--num_execution_workers", type=int, default=os.cpu_count(), help="Number of query execution processes with --pipeline")
+
+    parser.add_argument("--api_url", type=str, help="API URL to connect to, replicas of one model can be given as a comma-separated list")
     parser.add_argument("--auth_token", type=str, default="", help="Auth token for Transformers")
     parser.add_argument("--api_key", type=str, default="", help="API key")
     parser.add_argument("--transformers_cache", type=str, help="Transformers cache dir")
@@ -50,13 +90,31 @@ def parse_args():
 
     parser.add_argument("--seed", type=int, default=42, help="Random seed")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error("--shard_index must be between 0 and --num_shards - 1")
+    if args.batch_size and (args.use_tgi or args.use_vllm or args.use_openai or args.use_openchat_api):
+        parser.error("--batch_size is supported only with local Transformers models")
+    if args.vllm_batch_size > 1 and not args.use_vllm:
+        parser.error("--vllm_batch_size is supported only with --use_vllm")
+    if args.stream_early_stop and not args.use_tgi:
+        parser.error("--stream_early_stop is supported only with --use_tgi")
+    if args.in_db_comparison and args.gold_index:
+        # Gold results would be executed again to compare them inside SQLite, which drops the gain of the index
+        parser.error("--in_db_comparison cannot be combined with --gold_index")
+    if args.prefix_scheduling and not (args.async_generation or args.pipeline or args.batch_size):
+        parser.error("--prefix_scheduling requires --async_generation, --pipeline or --batch_size")
+    if args.logprob_detection and not args.ambig_detection:
+        parser.error("--logprob_detection requires --ambig_detection")
+    if args.logprob_detection and (args.use_openchat_api or args.batch_size or args.stream_early_stop):
+        parser.error("--logprob_detection is supported with VLLM, OpenAI and TGI servers and unbatched local Transformers models")
+    return args
 
 def init_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
 
-def setup_generation(args, generator, dataset, tokenizer=None):
+def empty_metrics(args):
     all_metrics = {'vague': {}, 'attachment': {}, 'scope': {}}
     if not args.ambig_detection:
         for amb_type in all_metrics.keys():
@@ -68,155 +126,186 @@ def setup_generation(args, generator, dataset, tokenizer=None):
             all_metrics[amb_type]['unique_results'] = []
             all_metrics[amb_type]['unique_results_filtered'] = []
             all_metrics[amb_type]['all_found'] = []
+            all_metrics[amb_type]['budget_exceeded'] = []
     else:
         for amb_type in all_metrics.keys():
             all_metrics[amb_type]['is_ambiguous'] = []
+            if args.logprob_detection:
+                all_metrics[amb_type]['ambiguity_score'] = []
+                all_metrics[amb_type]['ambiguous_question'] = []
+    return all_metrics
+
+def setup_generation(args, generator, dataset, tokenizer=None):
+    all_metrics = empty_metrics(args)
 
     if not os.path.exists('eval_logs'):
         os.mkdir('eval_logs')
 
+    db_connections.configure(in_memory=args.in_memory_db)
+
     eval_config = EvaluatorConfig(args, generator, dataset, tokenizer)
+    if args.gold_index:
+        eval_config.gold_index = GoldIndex(args.gold_index, args.croissant_file)
 
     if args.icl_pairs:
         write_icl_prompt(args, eval_config.prompt_template, dataset.df_few_shot_examples)
+    eval_config.prompt_assembler = PromptAssembler(args, eval_config.prompt_template, tokenizer)
+
+    if eval_config.concurrency is not None and isinstance(generator, RateLimitedClient):
+        # Rate limits hit during retries also lower the concurrency
+        generator.on_error = eval_config.concurrency.report_error
 
     return eval_config, all_metrics
 
 def evaluate(df_one_db_examples, eval_config):
-    file_name = df_one_db_examples['db_file'].iloc[0]
+    """Generate, parse and score the questions of one database, the results are written to the results stream."""
     db_dump = df_one_db_examples['db_dump'].iloc[0]
-    is_ambiguous = df_one_db_examples['is_ambiguous'].iloc[0]
 
-    metrics, results = [], []
-    for _, row in df_one_db_examples.iterrows():
+    for idx, row in df_one_db_examples.iterrows():
         example = row.to_dict()
 
         question = example['question']
-        gold_queries = example["gold_queries"]
 
-        cur_prompt = format_prompt(eval_config.args, eval_config.prompt_template, db_dump, question, eval_config.tokenizer)
+        if eval_config.precomputed_outputs is not None:
+            outputs = eval_config.precomputed_outputs[idx]
+        else:
+            cur_prompt = eval_config.prompt_assembler.format(db_dump, question)
 
-        # Generate
-        outputs = generate(eval_config.args, eval_config.generator, cur_prompt)
+            # Generate
+            outputs = generate(eval_config.args, eval_config.generator, cur_prompt, eval_config.cache, eval_config.concurrency, eval_config.early_stopper)
 
-        if eval_config.args.use_vllm:
-            statements = []
-            for choice in outputs:
-                one_stat = eval_config.parse_statements(choice)
-                statements += one_stat
-            outputs = "\n\n".join(outputs)
-        else:
-            statements = eval_config.parse_statements(outputs)
+        statements = parse_outputs(eval_config, outputs)
 
-        if eval_config.args.ambig_detection:
-            cor_res = "yes" if eval_config.args.type_of_questions == 'ambig' else "no"
-            is_ambiguous = statements == cor_res
-            metrics.append({'is_ambiguous': is_ambiguous})
-            results.append({'question': question, 'db_file': file_name, 'predictions': statements,'is_ambiguous': is_ambiguous})
-        else:
-            try:
-                if not statements:
-                    if 'select' in outputs.lower():
-                        # Could not find SQL query...
-                        continue
-            
-                    continue
-                else:
-                    local_metrics = evaluate_predicted_statements(file_name, statements, gold_queries)
-            except Exception as e:
-                continue
-
-            metrics.append(local_metrics)
-
-            local_metrics['question'] = question
-            local_metrics['db_file'] = file_name
-            local_metrics['predictions'] = statements
-            results.append(local_metrics)
-    
-    metrics_grouped = {}
-    for res_dict in metrics:
-        for type, value in res_dict.items():
-            if type not in metrics_grouped:
-                metrics_grouped[type] = []
-            metrics_grouped[type].append(value)
-    return metrics_grouped, results
+        scored = score_statements(eval_config.args, example, statements, eval_config.gold_index)
+        if eval_config.results_stream is not None:
+            eval_config.results_stream.write(example, scored[1] if scored is not None else None)
 
 def evaluate_one_type(eval_config, df_one_type):
-    if not eval_config.args.ambig_detection:
-        metrics_one_type = {
-                            'recall': [],
-                            'precision': [],
-                            'f1_score': [],
-                            'num_queries': [],
-                            'num_unique_queries': [],
-                            'unique_results': [],
-                            'unique_results_filtered': [],
-                            'all_found': []
-                        }
-    else:
-        metrics_one_type = {
-                            'is_ambiguous': []
-                            }
-    results_one_type = []
-
     grouped_df = df_one_type.groupby('db_file')
 
-    if eval_config.args.use_openai:
+    args = eval_config.args
+    openai_rate_limited = args.use_openai and (args.requests_per_minute or args.tokens_per_minute)
+    if args.use_openai and eval_config.concurrency is None and not openai_rate_limited:
         for _, df_one_db_examples in grouped_df:
-            one_db_metrics, one_db_results = evaluate(df_one_db_examples, eval_config)
-            for metric_type, res in one_db_metrics.items():
-                if metric_type in metrics_one_type:
-                    metrics_one_type[metric_type] += res
-            results_one_type += one_db_results
+            evaluate(df_one_db_examples, eval_config)
 
     else:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
+        # Adaptive concurrency and rate limits bound the requests in flight instead of the number of threads
+        max_workers = args.max_concurrency if eval_config.concurrency is not None or openai_rate_limited else 6
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
             result_futures = [executor.submit(evaluate, df_one_db_examples, eval_config) for _, df_one_db_examples in grouped_df]
+        # Errors of the workers
         for future in result_futures:
-            one_db_metrics, one_db_results = future.result()
-            for metric_type, res in one_db_metrics.items():
-                if metric_type in metrics_one_type:
-                    metrics_one_type[metric_type] += res
-            results_one_type += one_db_results
-
-    return metrics_one_type, results_one_type
+            future.result()
+
+def generate_all_outputs(eval_config, df):
+    requests = []
+    for idx, row in df.iterrows():
+        cur_prompt = eval_config.prompt_assembler.format(row['db_dump'], row['question'])
+        requests.append((idx, cur_prompt))
+    if eval_config.args.prefix_scheduling:
+        requests, eval_config.prefix_schedule = schedule_by_prefix(requests)
+    if eval_config.args.batch_size:
+        return eval_config.generator.generate_all(requests, eval_config.cache)
+    return generate_all(eval_config.args, requests, eval_config.cache, eval_config.concurrency, eval_config.early_stopper)
 
 def run_evaluation(args, generator, tokenizer=None):
-    dataset = Dataset(args.croissant_file)
+    dataset = Dataset(args.croissant_file, args.dataset_cache_dir)
     if args.type_of_questions:
         is_ambiguous = args.type_of_questions == 'ambig'
         dataset.df_test = dataset.df_test[dataset.df_test['is_ambiguous'] == is_ambiguous]
 
+    if args.num_shards > 1:
+        dataset.df_test = shard_questions(dataset.df_test, args.shard_index, args.num_shards)
+
     eval_config, all_metrics = setup_generation(args, generator, dataset, tokenizer)
 
+    run_stats = {}
+    if args.dump_token_budget or args.max_prompt_tokens:
+        dataset.df_test, run_stats['prompt_tokens'] = apply_token_budget(eval_config, dataset.df_test, load_token_counter(args, tokenizer))
+        print(f"Prompt tokens: max {run_stats['prompt_tokens']['max']}, {run_stats['prompt_tokens']['rejected']} questions rejected")
+
+    shard_index = args.shard_index if args.num_shards > 1 else None
+    _, res_file_name = results_file_names(args, shard_index)
+    stream_file = res_file_name + "l"
+    if args.resume:
+        done = completed_keys(stream_file, args.seed)
+        not_done = [(question, db_file) not in done for question, db_file in zip(dataset.df_test['question'], dataset.df_test['db_file'])]
+        dataset.df_test = dataset.df_test[not_done]
+        print(f"Resuming {stream_file}: {len(done)} questions already evaluated")
+    eval_config.results_stream = ResultsStream(stream_file, args.seed, resume=args.resume)
+
+    if args.async_generation or args.batch_size:
+        # Generate for all ambiguity types at once, scoring below only reads the stored outputs
+        eval_config.precomputed_outputs = generate_all_outputs(eval_config, dataset.df_test)
+
+    if args.pipeline:
+        run_stats['pipeline'] = run_pipeline(eval_config, dataset.df_test)
+    else:
+        for ambig_type in dataset.df_test['ambig_type'].unique():
+            dataset_one_type = dataset.df_test[dataset.df_test['ambig_type'] == ambig_type]
+            evaluate_one_type(eval_config, dataset_one_type)
+    eval_config.results_stream.close()
+
+    # Metrics are aggregated from the stream, which also holds the questions evaluated before --resume
+    all_results = aggregate_results_stream(stream_file, args.seed, all_metrics)
+
+    if eval_config.prefix_schedule is not None:
+        run_stats['prefix_schedule'] = eval_config.prefix_schedule
+    if eval_config.concurrency is not None:
+        concurrency_log = os.path.join('eval_logs', "concurrency_" + os.path.basename(res_file_name))
+        with open(concurrency_log, 'w') as f:
+            json.dump([{'seconds': seconds, 'limit': limit, 'reason': reason} for seconds, limit, reason in eval_config.concurrency.history], f)
+        run_stats['concurrency'] = eval_config.concurrency.stats()
+        run_stats['concurrency']['log'] = concurrency_log
+    if eval_config.early_stopper is not None:
+        run_stats['early_stop'] = eval_config.early_stopper.stats()
+        print(f"Early stopped {run_stats['early_stop']['early_stops']} of {run_stats['early_stop']['requests']} completions, {run_stats['early_stop']['tokens_saved']} tokens saved")
+    if eval_config.cache is not None:
+        run_stats['completion_cache'] = eval_config.cache.stats()
+
+    save_results_to_file(args, all_metrics, all_results, run_stats, shard_index)
+
+
+def shard_questions(df, shard_index, num_shards):
+    """Questions of one shard, assigned by a hash of (db_file, question) that does not depend on the process or the order of df."""
+    def shard_of(db_file, question):
+        digest = hashlib.sha256(f"{db_file}\n{question}".encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % num_shards
+    in_shard = [shard_of(db_file, question) == shard_index for db_file, question in zip(df['db_file'], df['question'])]
+    return df[in_shard]
+
+def aggregate_results_stream(stream_file, seed, all_metrics):
+    """Add the metrics of every result in a results stream to all_metrics, returns the results."""
     all_results = []
-    for ambig_type in dataset.df_test['ambig_type'].unique():
-        dataset_one_type = dataset.df_test[dataset.df_test['ambig_type'] == ambig_type]
-        metrics_of_all_datasets, results_of_all_datasets = evaluate_one_type(eval_config, dataset_one_type)
-        
-        for metric, values in metrics_of_all_datasets.items():
-            all_metrics[ambig_type][metric] += values
-        all_results += results_of_all_datasets
-
-    save_results_to_file(args, all_metrics, all_results)
-
-
-def save_results_to_file(args, all_metrics, all_results):
-    if not os.path.exists("experiment_results"):
-        os.mkdir("experiment_results")
-
+    for record in read_results_stream(stream_file):
+        if record['seed'] != seed or record['result'] is None:
+            continue
+        all_results.append(record['result'])
+        for metric, values in all_metrics[record['ambig_type']].items():
+            values.append(record['result'][metric])
+    return all_results
+
+def results_file_names(args, shard_index=None):
     path_to_res = os.path.join("experiment_results", f"{args.model}")
-    if not os.path.exists(path_to_res):
-        os.mkdir(path_to_res)
+    os.makedirs(path_to_res, exist_ok=True)
 
+    experiment_name = args.prompt_file.split('/')[-1]
     if args.experiment_name:
-        args.experiment_name = args.prompt_file.split('/')[-1] + f"_{args.experiment_name}"
-    else:
-        args.experiment_name = args.prompt_file.split('/')[-1]
+        experiment_name += f"_{args.experiment_name}"
 
     suffix = f"_{args.icl_strategy}{args.icl_pairs}" if args.icl_pairs else ""
     suffix += "_detect"  if args.ambig_detection else ""
     suffix += f"_rs{args.seed}" if args.seed else ""
+    suffix += f"_shard{shard_index}of{args.num_shards}" if shard_index is not None else ""
+
+    metrics_file_name = f"{path_to_res}/metrics_{args.model}_{args.type_of_questions}_{experiment_name}{suffix}.json"
+    res_file_name = f"{path_to_res}/predictions_{args.model}_{args.type_of_questions}_{experiment_name}{suffix}.json"
+    return metrics_file_name, res_file_name
+
+def save_results_to_file(args, all_metrics, all_results, run_stats=None, shard_index=None):
+    metrics_file_name, res_file_name = results_file_names(args, shard_index)
+    args.experiment_name = args.prompt_file.split('/')[-1] + (f"_{args.experiment_name}" if args.experiment_name else "")
 
     agg_all_metrics = {}
     micro_average_metrics = {}
@@ -230,18 +319,28 @@ def save_results_to_file(args, all_metrics, all_results):
             if res_type not in micro_average_metrics:
                 micro_average_metrics[res_type] = []
             micro_average_metrics[res_type] += all_res
+        if 'ambiguity_score' in all_metrics[amb_type]:
+            agg_all_metrics[amb_type]['roc_auc'] = roc_auc(all_metrics[amb_type]['ambiguous_question'], all_metrics[amb_type]['ambiguity_score'])
+            print("roc_auc", ",", agg_all_metrics[amb_type]['roc_auc'])
         print()
 
     print(f'Micro-average metrics')
+    if 'ambiguity_score' in micro_average_metrics:
+        # Computed before the lists are replaced by their means
+        micro_roc_auc = roc_auc(micro_average_metrics['ambiguous_question'], micro_average_metrics['ambiguity_score'])
     for res_type, all_res in micro_average_metrics.items():
         micro_average_metrics[res_type] = np.mean(all_res)
         print(res_type, ",", micro_average_metrics[res_type])
+    if 'ambiguity_score' in micro_average_metrics:
+        micro_average_metrics['roc_auc'] = micro_roc_auc
+        print("roc_auc", ",", micro_roc_auc)
 
     agg_all_metrics['micro-average'] = micro_average_metrics
 
-    metrics_file_name = f"{path_to_res}/metrics_{args.model}_{args.type_of_questions}_{args.experiment_name}{suffix}.json"
-    res_file_name = f"{path_to_res}/predictions_{args.model}_{args.type_of_questions}_{args.experiment_name}{suffix}.json"
-    json.dump({'metrics': agg_all_metrics, 'parameters': vars(args)}, open(metrics_file_name, 'w'), indent=4)
+    metrics_json = {'metrics': agg_all_metrics, 'parameters': vars(args)}
+    if run_stats:
+        metrics_json['run_stats'] = run_stats
+    json.dump(metrics_json, open(metrics_file_name, 'w'), indent=4)
     json.dump(all_results, open(res_file_name, 'w'), indent=4)
     print(f'Results saved to {res_file_name}')
     print(f'Metrics saved to {metrics_file_name}')
\ No newline at end of file
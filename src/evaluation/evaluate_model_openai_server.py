@@ -1,5 +1,15 @@
+import os
+import sys
+
 from openai import OpenAI
+
+# Modules shared with the database generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
 from eval import parse_args, init_seed, run_evaluation
+from load_balancer import balanced_client
+from rate_limits import create_rate_limited_client
+from vllm_batching import batched_completions_client
 
 if __name__ == "__main__":  
     args = parse_args()
@@ -7,9 +17,11 @@ if __name__ == "__main__":
 
     args.model =  args.model_name.split('/')[-1]
 
-    if args.use_vllm or args.use_openchat_api:
-        generator = OpenAI(base_url=args.api_url, api_key=args.api_key)
+    if args.use_vllm:
+        generator = batched_completions_client(args, balanced_client(args.api_url, lambda url: OpenAI(base_url=url, api_key=args.api_key)))
+    elif args.use_openchat_api:
+        generator = balanced_client(args.api_url, lambda url: OpenAI(base_url=url, api_key=args.api_key))
     elif args.use_openai:
-        generator = OpenAI(api_key=args.api_key)
+        generator = create_rate_limited_client(args, OpenAI(api_key=args.api_key, max_retries=0))
 
     run_evaluation(args, generator)
\ No newline at end of file
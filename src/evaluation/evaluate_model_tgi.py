@@ -1,19 +1,29 @@
+import os
+import sys
+
 import torch 
 import transformers
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from huggingface_hub import InferenceClient
 
+# Modules shared with the database generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
 from eval import parse_args, init_seed, run_evaluation
+from load_balancer import balanced_client
+from batched_generation import BatchedGenerator
 
 def create_generator(args):
     if args.use_tgi:
-        client = InferenceClient(model=args.api_url)
+        client = balanced_client(args.api_url, lambda url: InferenceClient(model=url))
         return client
     else:
-        device = torch.device('cuda')
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         tokenizer = AutoTokenizer.from_pretrained(args.model_name, token=args.auth_token, cache_dir=args.transformers_cache)
         model = AutoModelForCausalLM.from_pretrained(args.model_name, token=args.auth_token, cache_dir=args.transformers_cache)
         model.to(device)
+        if args.batch_size:
+            return BatchedGenerator(args, model, tokenizer)
         if args.use_transformers_beam:
             pipeline = transformers.pipeline("text-generation", 
                                         model=model,
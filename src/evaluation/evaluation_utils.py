@@ -1,35 +1,37 @@
-import time
-import re
-import sqlite3
+import os
+import hashlib
+import contextlib
 from collections import defaultdict
 
 import pandas as pd
-import mlcroissant as mlc
 
 from output_parsers import *
+from completion_cache import CompletionCache
+from concurrency import AdaptiveConcurrency
+from streaming import EarlyStopper
+from ambiguity_scoring import score_ambiguity
+from metrics import evaluate_predicted_statements
+from db_connections import open_read_only
+
+def get_column_names(db_path, table_name, conn=None):
+    if conn is None:
+        with contextlib.closing(open_read_only(db_path)) as conn:
+            return get_column_names(db_path, table_name, conn)
 
-def get_column_names(db_path, table_name):
-    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
-    
     cursor.execute(f"PRAGMA table_info({table_name});")
     rows = cursor.fetchall()
     column_names = [row[1] for row in rows]
-    conn.close()
     return column_names
 
-def merge_all_insert_statements(db_path, db_dump):
-    # Regex to find all INSERT INTO statements
-    pattern = re.compile(r"INSERT INTO \"(\w+)\" VALUES (\(.*?\));", re.IGNORECASE)
-    
+def merge_insert_statements(db_path, lines):
+    """Merge all INSERT INTO statements of a dump, given as an iterable of lines, into one statement per table."""
     # Dictionary to store values for each table
     table_inserts = defaultdict(list)
 
-    new_content = ""
+    new_content = []
 
-    # Process the dump line by line
-    for line in db_dump.split('\n'):
-        match = pattern.search(line)
+    for line in lines:
         if "INSERT INTO " in line:
             table_name = line[line.find("INSERT INTO ") + len("INSERT INTO "):line.find(" VALUES(")]
             line = line[line.find("VALUES")+ len("VALUES"):-1]
@@ -40,21 +42,49 @@ def merge_all_insert_statements(db_path, db_dump):
         elif "BEGIN TRANSACTION" in line or "COMMIT" in line or "DELETE" in line:
             continue
         else:
-            new_content += line + "\n"
+            new_content.append(line + "\n")
 
-    # Create a single INSERT INTO statement for each table
-    for table_name, values in table_inserts.items():
-        if values:
-            col_names = get_column_names(db_path, table_name)
-            new_content += f"INSERT INTO {table_name} (" + ",".join(col_names) + ") VALUES " + ",".join(values) + ";\n"
+    # Create a single INSERT INTO statement for each table, column names are read through one read-only connection
+    if table_inserts:
+        with contextlib.closing(open_read_only(db_path)) as conn:
+            for table_name, values in table_inserts.items():
+                col_names = get_column_names(db_path, table_name, conn)
+                new_content.append(f"INSERT INTO {table_name} (" + ",".join(col_names) + ") VALUES " + ",".join(values) + ";\n")
+
+    return "".join(new_content)
+
+def merge_all_insert_statements(db_path, db_dump):
+    return merge_insert_statements(db_path, db_dump.split('\n'))
 
-    return new_content
+# Increase when _parse_jsonld changes the parsed dataframe
+DATASET_CACHE_VERSION = "1"
+
+def file_hash(file_name):
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 class Dataset:
-    def __init__(self, croissant_file):
-        dataset = mlc.Dataset(jsonld=croissant_file)
-        self.data = dataset.records(record_set="examples")
-        self.df = self._parse_jsonld(self.data)
+    def __init__(self, croissant_file, cache_dir=None):
+        """Parsed dataset, with cache_dir the parsed dataframe is stored in a file named after the hash of croissant_file."""
+        self.df = None
+        if cache_dir is not None:
+            cache_file = os.path.join(cache_dir, f"dataset_v{DATASET_CACHE_VERSION}_{file_hash(croissant_file)}.pkl")
+            if os.path.exists(cache_file):
+                self.df = pd.read_pickle(cache_file)
+
+        if self.df is None:
+            # mlcroissant is slow to import and only needed when the dataset is not cached
+            import mlcroissant as mlc
+            dataset = mlc.Dataset(jsonld=croissant_file)
+            self.data = dataset.records(record_set="examples")
+            self.df = self._parse_jsonld(self.data)
+            if cache_dir is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                self.df.to_pickle(cache_file + ".tmp")
+                os.replace(cache_file + ".tmp", cache_file)
         self.create_splits()
     
     def _parse_jsonld(self, jsonld_data):
@@ -65,47 +95,41 @@ class Dataset:
         df['gold_queries'] = df['gold_queries'].str.split('\n\n')
         df.loc[df['ambig_type'] == 'attachment', 'question'] += " Show them in one table."
         df.loc[df['ambig_type'] == 'attachment', 'ambig_question'] += " Show them in one table."
-        df['db_dump'] = df.apply(lambda row: merge_all_insert_statements(row['db_file'], row['db_dump']), axis=1)
+        # Questions on the same database share one merged dump instead of a copy per row
+        db_dumps = {}
+        for db_file, db_dump in zip(df['db_file'], df['db_dump']):
+            if db_file not in db_dumps:
+                db_dumps[db_file] = merge_all_insert_statements(db_file, db_dump)
+        df['db_dump'] = df['db_file'].map(db_dumps)
         return df
     
     def create_splits(self):
         self.df_test = self.df[self.df['split'] == 'test']
         self.df_few_shot_examples = self.df[self.df['split'] == 'few_shot_examples']
 
-def generate(args, generator, prompt): 
+def build_request(args, prompt):
     if args.use_vllm:
-        completion = generator.completions.create(
+        return dict(
                 model=args.model_name,
                 prompt=prompt,
                 extra_body={"use_beam_search": True, "best_of": 5}, 
                 temperature=0.0, 
                 n=5,
                 max_tokens=500, seed=args.seed)
-        outputs = [row.text for row in completion.choices]
     elif args.use_openai:
-        while True:
-            try:
-                response = generator.chat.completions.create(
-                    model=args.model,
-                    messages=[{'role': 'user', 'content': prompt}],
-                    temperature=args.temperature, 
-                    max_tokens=500,
-                    seed=args.seed)
-                break
-            except Exception as e:
-                print(e)
-                time.sleep(30)
-
-        outputs = response.choices[0].message.content
+        return dict(
+                model=args.model,
+                messages=[{'role': 'user', 'content': prompt}],
+                temperature=args.temperature, 
+                max_tokens=500,
+                seed=args.seed)
     elif args.use_openchat_api:
-        response = generator.chat.completions.create(
-            model="openchat_3.5",
-            messages= [{"role": "user", "content": prompt}],
-            temperature=args.temperature,
-            top_p=args.top_p,
-            seed=args.seed
-        )
-        outputs = response.choices[0].message.content
+        return dict(
+                model="openchat_3.5",
+                messages= [{"role": "user", "content": prompt}],
+                temperature=args.temperature,
+                top_p=args.top_p,
+                seed=args.seed)
     elif args.use_tgi:
         params = {
             'prompt': prompt, 
@@ -121,7 +145,51 @@ def generate(args, generator, prompt):
             params['seed'] = args.seed
         if args.repetition_penalty:
             params['repetition_penalty'] = args.repetition_penalty
-        outputs = generator.text_generation(**params)
+        return params
+    raise ValueError("Requests are built only for VLLM, OpenAI, OpenChat and TGI servers")
+
+def parse_response(args, response):
+    if args.use_vllm:
+        return [row.text for row in response.choices]
+    elif args.use_openai or args.use_openchat_api:
+        return response.choices[0].message.content
+    return response
+
+def generate(args, generator, prompt, cache=None, concurrency=None, early_stopper=None):
+    if cache is not None:
+        key = cache.make_key(args, prompt)
+        outputs = cache.get(key)
+        if outputs is not None:
+            return outputs
+
+    if concurrency is None:
+        outputs = _generate(args, generator, prompt, early_stopper)
+    else:
+        with concurrency.slot():
+            outputs = _generate(args, generator, prompt, early_stopper)
+
+    if cache is not None:
+        cache.put(key, outputs)
+    return outputs
+
+def _generate(args, generator, prompt, early_stopper=None): 
+    if args.logprob_detection:
+        outputs = score_ambiguity(args, generator, prompt)
+    elif args.use_vllm:
+        completion = generator.completions.create(**build_request(args, prompt))
+        outputs = parse_response(args, completion)
+    elif args.use_openai:
+        # Rate limits and retries are handled by rate_limits.RateLimitedClient
+        response = generator.chat.completions.create(**build_request(args, prompt))
+
+        outputs = parse_response(args, response)
+    elif args.use_openchat_api:
+        response = generator.chat.completions.create(**build_request(args, prompt))
+        outputs = parse_response(args, response)
+    elif args.use_tgi and early_stopper is not None:
+        outputs = early_stopper.generate(generator, build_request(args, prompt))
+    elif args.use_tgi:
+        outputs = generator.text_generation(**build_request(args, prompt))
 
     elif args.use_transformers_beam:
         sequences = generator(prompt,
@@ -138,6 +206,61 @@ def generate(args, generator, prompt):
         
     return outputs
 
+def parse_outputs(eval_config, outputs):
+    if eval_config.args.logprob_detection:
+        # Scored answers are already parsed
+        statements = outputs
+    elif eval_config.args.use_vllm:
+        statements = []
+        for choice in outputs:
+            one_stat = eval_config.parse_statements(choice)
+            statements += one_stat
+    else:
+        statements = eval_config.parse_statements(outputs)
+    return statements
+
+# Added to the questions by prompt_budget.apply_token_budget
+TOKEN_COUNT_COLUMNS = ['prompt_tokens', 'dump_tokens', 'compacted_dump_tokens']
+
+def score_statements(args, example, statements, gold_index=None):
+    """Metrics and stored result for one question, None if the question is skipped."""
+    question = example['question']
+    file_name = example['db_file']
+    gold_queries = example["gold_queries"]
+
+    if args.ambig_detection:
+        # Label of the question itself, runs without --type_of_questions have both classes
+        cor_res = "yes" if example['is_ambiguous'] else "no"
+        answer = statements['answer'] if args.logprob_detection else statements
+        is_ambiguous = answer == cor_res
+        result = {'question': question, 'db_file': file_name, 'predictions': answer,'is_ambiguous': is_ambiguous}
+        metrics = {'is_ambiguous': is_ambiguous}
+        if args.logprob_detection:
+            # Score and label of every question, for the ROC AUC of the run
+            metrics.update(ambiguity_score=statements['score'], ambiguous_question=bool(example['is_ambiguous']))
+            result.update(metrics)
+        result.update({key: int(example[key]) for key in TOKEN_COUNT_COLUMNS if key in example})
+        return metrics, result
+
+    if not statements:
+        # Could not find SQL query...
+        return None
+
+    try:
+        gold_fingerprints = None
+        if gold_index is not None:
+            gold_fingerprints = gold_index.gold_fingerprints(file_name, gold_queries)
+        local_metrics = evaluate_predicted_statements(file_name, statements, gold_queries, gold_fingerprints=gold_fingerprints,
+                                                      query_timeout=args.query_timeout, max_rows=args.max_result_rows,
+                                                      in_db_comparison=args.in_db_comparison)
+    except Exception as e:
+        return None
+
+    local_metrics['question'] = question
+    local_metrics['db_file'] = file_name
+    local_metrics['predictions'] = statements
+    local_metrics.update({key: int(example[key]) for key in TOKEN_COUNT_COLUMNS if key in example})
+    return local_metrics, local_metrics
 
 class EvaluatorConfig:
     def __init__(self, args, generator, dataset=None, tokenizer=None):
@@ -145,6 +268,13 @@ class EvaluatorConfig:
         self.generator = generator
         self.tokenizer = tokenizer
         self.dataset = dataset
+        self.precomputed_outputs = None
+        self.cache = CompletionCache(args.completion_cache) if args.completion_cache else None
+        self.gold_index = None
+        self.prefix_schedule = None
+        self.prompt_assembler = None
+        self.results_stream = None
+        self.concurrency = AdaptiveConcurrency(args.initial_concurrency, maximum=args.max_concurrency) if args.adaptive_concurrency else None
         
         if args.use_vllm or args.use_transformers_beam:
             self.parse_statements = parse_single_statement
@@ -160,6 +290,7 @@ class EvaluatorConfig:
             self.parse_statements = parse_statements_codellama
         elif 'llama' in args.model.lower():
             self.parse_statements = parse_statements_llama
+        self.early_stopper = EarlyStopper(self.parse_statements, args.early_stop_patience, args.max_new_tokens) if args.stream_early_stop else None
 
         with open(self.args.prompt_file, 'r') as f:
             self.prompt_template = f.read()
\ No newline at end of file
@@ -88,4 +88,18 @@ class PredQueryExecutionError(Exception):
         return {
             'query': self.query,
             'original_exception': f"{self.original_exception}"
-        }
\ No newline at end of file
+        }
+
+class QueryBudgetExceededError(PredQueryExecutionError):
+    def __init__(self, query, limit_type, limit):
+        self.limit_type = limit_type
+        self.limit = limit
+        super().__init__(query, f"{limit_type} limit of {limit} exceeded")
+
+    def to_dict(self):
+        """Convert exception data to a dictionary, which can then be easily serialized to JSON."""
+        return {
+            'query': self.query,
+            'original_exception': f"{self.original_exception}",
+            'budget_exceeded': self.limit_type
+        }
@@ -41,6 +41,46 @@ def format_prompt(args, prompt_template, db_dump, question, tokenizer=None):
     else:
         return cur_prompt
         
+class PromptAssembler:
+    """Gives the same prompts as format_prompt, with the ICL examples read once and the prompt around the question memoized per database."""
+    # Stands for the question while the chat template is applied to the rest of the prompt
+    QUESTION_PLACEHOLDER = "\x00QUESTION\x00"
+    PROBE_QUESTION = "Which rows are there?"
+
+    def __init__(self, args, prompt_template, tokenizer=None):
+        self.args = args
+        self.prompt_template = prompt_template
+        self.tokenizer = tokenizer
+        self.template = read_icl_prompt(args, prompt_template) if args.icl_pairs else prompt_template
+        # db_dump -> parts of the prompt joined by the question, None when the chat template cannot be split
+        self.parts = {}
+
+    def _apply_chat_template(self, content):
+        return self.tokenizer.apply_chat_template([{"role": "user", "content": content}], tokenize=False)
+
+    def _compile(self, db_dump):
+        parts = self.template.replace('SQL_DATABASE_DUMP', db_dump).split('QUESTION')
+        if not self.args.use_tgi:
+            return parts
+
+        content = self.QUESTION_PLACEHOLDER.join(parts)
+        templated_parts = self._apply_chat_template(content).split(self.QUESTION_PLACEHOLDER)
+        # Chat templates may transform the content (e.g. trim it), check that splicing matches applying the template
+        expected = self._apply_chat_template(self.PROBE_QUESTION.join(parts))
+        if len(templated_parts) != len(parts) or self.PROBE_QUESTION.join(templated_parts) != expected:
+            return None
+        return templated_parts
+
+    def format(self, db_dump, question):
+        if db_dump not in self.parts:
+            self.parts[db_dump] = self._compile(db_dump)
+        parts = self.parts[db_dump]
+
+        # Whitespace around the question could be trimmed by the chat template
+        if parts is None or (self.args.use_tgi and question != question.strip()):
+            return format_prompt(self.args, self.prompt_template, db_dump, question, self.tokenizer)
+        return question.join(parts)
+
 def format_icl_example_one_item_sql(ambig_item, unambig_items, num_ex=None):
     db_dump = filter_db_dump(ambig_item["db_dump"], ambig_item['ambig_queries'])
     
@@ -0,0 +1,108 @@
+import os
+import sys
+import zlib
+import pickle
+import sqlite3
+import argparse
+import threading
+
+# Modules shared with the database generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
+from evaluation_utils import Dataset, file_hash
+from db_connections import open_read_only
+from metrics import ResultFingerprint, duplicate_exact
+from exceptions import DublicatesError, GoldQueryExecutionError
+
+# Increase when the stored fingerprints change
+INDEX_VERSION = "2"
+
+def build_gold_index(croissant_file, index_file):
+    """Execute all gold queries of the dataset once and store their results in a SQLite file."""
+    dataset = Dataset(croissant_file)
+
+    conn = sqlite3.connect(index_file)
+    conn.executescript("""
+        DROP TABLE IF EXISTS meta;
+        DROP TABLE IF EXISTS gold_results;
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE gold_results (db_file TEXT, query TEXT, fingerprint BLOB, rows BLOB, error TEXT, PRIMARY KEY (db_file, query));
+    """)
+    conn.execute("INSERT INTO meta VALUES ('croissant_sha256', ?)", (file_hash(croissant_file),))
+    conn.execute("INSERT INTO meta VALUES ('version', ?)", (INDEX_VERSION,))
+
+    for db_file, df_one_db in dataset.df.groupby('db_file'):
+        db_conn = open_read_only(db_file)
+        cursor = db_conn.cursor()
+
+        for query in {query for gold_queries in df_one_db['gold_queries'] for query in gold_queries}:
+            try:
+                cursor.execute(query)
+                rows = cursor.fetchall()
+                fingerprint = ResultFingerprint.from_rows(rows)
+                conn.execute("INSERT INTO gold_results VALUES (?, ?, ?, ?, NULL)",
+                             (db_file, query, pickle.dumps(fingerprint.to_tuple()), zlib.compress(pickle.dumps(rows))))
+            except sqlite3.DatabaseError as e:
+                conn.execute("INSERT INTO gold_results VALUES (?, ?, NULL, NULL, ?)", (db_file, query, str(e)))
+        db_conn.close()
+
+    conn.commit()
+    conn.close()
+
+class GoldIndex:
+    """Read access to a file written by build_gold_index, results are loaded per database on first use."""
+    def __init__(self, index_file, croissant_file=None):
+        self.conn = sqlite3.connect(f"file:{index_file}?mode=ro", uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.results = {}
+
+        meta = dict(self.conn.execute("SELECT key, value FROM meta").fetchall())
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError(f"Gold index {index_file} has an outdated format, rebuild it with gold_index.py")
+        if croissant_file is not None and meta['croissant_sha256'] != file_hash(croissant_file):
+            raise ValueError(f"Gold index {index_file} was built for a different version of {croissant_file}, rebuild it with gold_index.py")
+
+    def _load_db(self, db_file):
+        with self.lock:
+            if db_file not in self.results:
+                rows = self.conn.execute("SELECT query, fingerprint, error FROM gold_results WHERE db_file = ?", (db_file,)).fetchall()
+                self.results[db_file] = {
+                    query: (ResultFingerprint(*pickle.loads(fingerprint)) if fingerprint is not None else None, error)
+                    for query, fingerprint, error in rows
+                }
+        return self.results[db_file]
+
+    def _load_rows(self, db_file, query):
+        with self.lock:
+            blob = self.conn.execute("SELECT rows FROM gold_results WHERE db_file = ? AND query = ?", (db_file, query)).fetchone()[0]
+        return pickle.loads(zlib.decompress(blob))
+
+    def gold_fingerprints(self, db_file, gold_queries):
+        """Stored fingerprints of the gold queries of one question, raises the same errors as evaluate_predicted_statements."""
+        db_results = self._load_db(db_file)
+
+        gold_fingerprints = {}
+        for query in gold_queries:
+            if query not in db_results:
+                raise KeyError(f"Gold query is missing from the index: {query}")
+            fingerprint, error = db_results[query]
+            if error is not None:
+                raise GoldQueryExecutionError(query, sqlite3.DatabaseError(error))
+            gold_fingerprints[query] = fingerprint
+
+        has_duplicates, duplicate_idx = duplicate_exact(list(gold_fingerprints.values()))
+        if has_duplicates:
+            # Rows are only needed for the error message
+            duplicate_query = list(gold_fingerprints)[duplicate_idx - 1]
+            raise DublicatesError(tuple(map(tuple, self._load_rows(db_file, duplicate_query))), duplicate_idx)
+
+        return gold_fingerprints
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute execution results of gold queries.")
+    parser.add_argument("--croissant_file", type=str, default="data/ambrosia_croissant.json", help="Dataset in croissant format")
+    parser.add_argument("--index_file", type=str, default="data/gold_index.sqlite", help="Output file for the gold results index")
+    args = parser.parse_args()
+
+    build_gold_index(args.croissant_file, args.index_file)
+    print(f'Gold index saved to {args.index_file}')
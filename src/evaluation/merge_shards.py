@@ -0,0 +1,22 @@
+import os
+import sys
+
+# Modules shared with the database generation scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+
+from eval import parse_args, empty_metrics, results_file_names, aggregate_results_stream, save_results_to_file
+
+if __name__ == "__main__":
+    # Takes the same arguments as the sharded runs, --shard_index is ignored
+    args = parse_args()
+    args.model = args.model_name.split('/')[-1]
+
+    all_metrics = empty_metrics(args)
+    all_results = []
+    for shard_index in range(args.num_shards):
+        stream_file = results_file_names(args, shard_index)[1] + "l"
+        if not os.path.exists(stream_file):
+            raise FileNotFoundError(f"Results of shard {shard_index} not found: {stream_file}")
+        all_results += aggregate_results_stream(stream_file, args.seed, all_metrics)
+
+    save_results_to_file(args, all_metrics, all_results, {'merged_shards': args.num_shards})
@@ -1,7 +1,11 @@
-from collections import Counter
 import sqlite3
+import hashlib
 
-from exceptions import DublicatesError, MetricError, GoldQueryExecutionError, PredQueryExecutionError
+import numpy as np
+
+from canonical_sql import canonicalize_query
+from db_connections import get_connection, execute_query, iter_query_batches, execution_budget, temp_tables_allowed
+from exceptions import DublicatesError, GoldQueryExecutionError, PredQueryExecutionError, QueryBudgetExceededError
 
 def sort_key(x):
     if x is None:
@@ -15,38 +19,80 @@ def sort_with_different_types(arr):
     sorted_arr = sorted(arr, key=sort_key)
     return sorted_arr
 
-def compare_query_results(predicted_results, gold_results, order_by=False):
-    if not predicted_results:
-        return False
+def roc_auc(labels, scores):
+    """Area under the ROC curve of scores for binary labels, from the ranks of the scores (ties count as half).
 
-    if order_by:
-        if len(gold_results) != len(predicted_results):
-            return False
-    
-        if any(len(row) != len(gold_results[0]) for row in gold_results + predicted_results):
-            return False
-    
-        for gold_row, predicted_row in zip(gold_results, predicted_results):
-            if tuple(sort_with_different_types(gold_row)) != tuple(sort_with_different_types(predicted_row)):
-                return False
-        return True
-    else:
-        flat_gold = Counter(item for row in gold_results for item in row)
-        flat_predicted = Counter(item for row in predicted_results for item in row)
+    None if only one class is present.
+    """
+    labels = np.asarray(labels, dtype=bool)
+    scores = np.asarray(scores, dtype=float)
+    num_positive = int(labels.sum())
+    num_negative = len(labels) - num_positive
+    if not num_positive or not num_negative:
+        return None
 
-        return flat_gold == flat_predicted
+    # Tied scores get the mean of their ranks
+    _, inverse, counts = np.unique(scores, return_inverse=True, return_counts=True)
+    ranks = (np.cumsum(counts) - (counts - 1) / 2)[inverse]
+    return float((ranks[labels].sum() - num_positive * (num_positive + 1) / 2) / (num_positive * num_negative))
 
-def duplicate_exact(results):
-    # Convert each result set into a tuple of tuples to make them hashable
-    hashable_results = [tuple(map(tuple, result)) for result in results]
-    
+MULTISET_HASH_MASK = (1 << 128) - 1
+
+def canonical_value(x):
+    # 1 and 1.0 are equal in Python comparisons and must have the same digest
+    if isinstance(x, float) and x.is_integer():
+        return int(x)
+    return x
+
+def value_hash(x):
+    return int.from_bytes(hashlib.blake2b(repr(x).encode('utf-8'), digest_size=16).digest(), 'big')
+
+class ResultFingerprint:
+    """Digests of one execution result, computed in one pass over its rows.
+
+    exact: rows in the original order (same as comparing tuples of tuples)
+    ordered: rows in the original order with values of each row sorted (comparison with ORDER BY)
+    multiset: multiset of all values regardless of rows (comparison without ORDER BY)
+    """
+    __slots__ = ('exact', 'ordered', 'multiset', 'num_rows')
+
+    def __init__(self, exact, ordered, multiset, num_rows):
+        self.exact = exact
+        self.ordered = ordered
+        self.multiset = multiset
+        self.num_rows = num_rows
+
+    @classmethod
+    def from_batches(cls, batches):
+        exact = hashlib.blake2b(digest_size=16)
+        ordered = hashlib.blake2b(digest_size=16)
+        multiset, num_values, num_rows = 0, 0, 0
+        for batch in batches:
+            for row in batch:
+                row = tuple(canonical_value(x) for x in row)
+                exact.update(repr(row).encode('utf-8'))
+                ordered.update(repr(tuple(sort_with_different_types(row))).encode('utf-8'))
+                for x in row:
+                    multiset = (multiset + value_hash(x)) & MULTISET_HASH_MASK
+                num_values += len(row)
+                num_rows += 1
+        return cls(exact.digest(), ordered.digest(), (multiset, num_values), num_rows)
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls.from_batches([rows])
+
+    def to_tuple(self):
+        return (self.exact, self.ordered, self.multiset, self.num_rows)
+
+def duplicate_exact(fingerprints):
     # Use a set to identify duplicates
     seen = set()
-    for idx, result in enumerate(hashable_results):
-        if result in seen:
-            return True, result, idx + 1
-        seen.add(result)
-    return False, None, None
+    for idx, fingerprint in enumerate(fingerprints):
+        if fingerprint.exact in seen:
+            return True, idx + 1
+        seen.add(fingerprint.exact)
+    return False, None
 
 def count_unique_results(results):
     # Use a set to identify duplicates
@@ -56,40 +102,36 @@ def count_unique_results(results):
         if isinstance(result, PredQueryExecutionError):
             seen.add(None)
         else:
-            hashable_result = tuple(map(tuple, result))
-            seen.add(hashable_result)
+            seen.add(result.exact)
     
     return len(seen)
 
 def remove_duplicate_results(all_pred_exec_outputs):
-    # List of keys to remove
+    """Remove every query whose result matches the result of an earlier kept query (in place)."""
+    # Digests of kept results: ordered digests of all of them, ordered digests of queries with ORDER BY and
+    # multiset digests of queries without it, the comparison mode of a pair depends on both queries
+    kept_ordered, kept_ordered_order_by, kept_multiset = set(), set(), set()
     keys_to_remove = []
 
-    # List of queries already processed
-    processed_queries = list(all_pred_exec_outputs.keys())
-    
-    for i, query1 in enumerate(processed_queries):
-        if query1 in keys_to_remove:
-            continue  # Skip if this key is already marked for removal
+    for query, result in all_pred_exec_outputs.items():
+        if isinstance(result, PredQueryExecutionError):
+            continue  # Failed queries are never duplicates
         
-        result1 = all_pred_exec_outputs[query1]
+        order_by = 'order by' in query.lower()
+        if order_by:
+            is_duplicate = result.ordered in kept_ordered
+        else:
+            is_duplicate = result.ordered in kept_ordered_order_by or result.multiset in kept_multiset
 
-        if isinstance(result1, PredQueryExecutionError):
-            result1 = None
-        
-        for query2 in processed_queries[i+1:]:
-            if query2 in keys_to_remove:
-                continue  # Skip if this key is already marked for removal
-            
-            result2 = all_pred_exec_outputs[query2]
-            if isinstance(result2, PredQueryExecutionError):
-                result2 = None
-
-            order_by = 'order by' in query1.lower() or 'order by' in query2.lower()
-            
-            if compare_query_results(result1, result2, order_by):
-                # Mark query2 for removal if it's a duplicate of query1
-                keys_to_remove.append(query2)
+        if is_duplicate:
+            keys_to_remove.append(query)
+        elif result.num_rows:
+            # Empty results never match later queries
+            kept_ordered.add(result.ordered)
+            if order_by:
+                kept_ordered_order_by.add(result.ordered)
+            else:
+                kept_multiset.add(result.multiset)
     
     # Remove the marked keys from the dictionary
     for key in keys_to_remove:
@@ -97,73 +139,271 @@ def remove_duplicate_results(all_pred_exec_outputs):
     
     return all_pred_exec_outputs
 
-
-def evaluate_predicted_statements(file_name, pred_statements, gold_sql_queries, remove_duplicates_predictions=False, verbose=False):
-    conn = sqlite3.connect(file_name)
-    cursor = conn.cursor()
-
+def execute_gold_queries(cursor, gold_sql_queries):
     all_gold_exec_outputs = {}
-    exec_acc_per_gold_queries = {}
     for query in gold_sql_queries:
         try:
-            cursor.execute(query)
-            all_gold_exec_outputs[query] = cursor.fetchall()
-            exec_acc_per_gold_queries[query] = False
+            all_gold_exec_outputs[query] = execute_query(cursor, query)
         except sqlite3.DatabaseError as e:
             raise GoldQueryExecutionError(query, e)
+    return all_gold_exec_outputs
 
-    has_duplicates, duplicates, duplicate_idx = duplicate_exact(list(all_gold_exec_outputs.values()))
+def gold_fingerprints_of(all_gold_exec_outputs):
+    gold_fingerprints = {query: ResultFingerprint.from_rows(rows) for query, rows in all_gold_exec_outputs.items()}
+
+    has_duplicates, duplicate_idx = duplicate_exact(list(gold_fingerprints.values()))
     if has_duplicates:
+        duplicates = tuple(map(tuple, list(all_gold_exec_outputs.values())[duplicate_idx - 1]))
         raise DublicatesError(duplicates, duplicate_idx)
+    return gold_fingerprints
+
+class MaterializedResult:
+    """Execution result kept in a temporary table and compared inside SQLite, only booleans are fetched.
+
+    Comparisons with ORDER BY fall back to the fingerprint computed in Python.
+    """
+    def __init__(self, cursor, table, num_columns, num_rows):
+        self.cursor = cursor
+        self.table = table
+        self.num_columns = num_columns
+        self.num_rows = num_rows
+        self._fingerprint = None
+
+    @staticmethod
+    def _create_table(cursor, table, num_columns):
+        # Columns without declared types keep values exactly as the query returned them
+        cursor.execute(f"CREATE TEMP TABLE {table} ({', '.join(f'c{i}' for i in range(max(num_columns, 1)))})")
 
-    all_pred_exec_outputs = {}
-    num_queries = len(pred_statements)
-    pred_statements = list(set(pred_statements))
-    execution_errors = []
-    for query in pred_statements:
+    @classmethod
+    def create(cls, cursor, query, table, timeout=None, max_rows=None):
+        subquery = query.strip().rstrip(';')
+        conn = cursor.connection
         try:
-            cursor.execute(query)
-            all_pred_exec_outputs[query] = cursor.fetchall()
-        except sqlite3.DatabaseError as e:
-            all_pred_exec_outputs[query] = PredQueryExecutionError(query, e)
-            execution_errors.append(PredQueryExecutionError(query, e).to_dict())
+            with execution_budget(conn, query, timeout):
+                cursor.execute(f"SELECT * FROM (\n{subquery}\n) LIMIT 0")
+        except sqlite3.DatabaseError:
+            # Statements that cannot be a subquery (e.g. PRAGMA) run directly, as in the Python comparison
+            return cls.copy_rows(cursor, query, table, timeout, max_rows)
+        num_columns = len(cursor.description)
+
+        try:
+            with execution_budget(conn, query, timeout), temp_tables_allowed(conn):
+                cls._create_table(cursor, table, num_columns)
+                limit = f" LIMIT {max_rows + 1}" if max_rows is not None else ""
+                cursor.execute(f"INSERT INTO temp.{table} SELECT * FROM (\n{subquery}\n){limit}")
+        except (sqlite3.DatabaseError, QueryBudgetExceededError):
+            cls(cursor, table, num_columns, 0).drop()
+            raise
+
+        result = cls(cursor, table, num_columns, cursor.execute(f"SELECT count(*) FROM temp.{table}").fetchone()[0])
+        if max_rows is not None and result.num_rows > max_rows:
+            result.drop()
+            raise QueryBudgetExceededError(query, 'max_rows', max_rows)
+        return result
+
+    @classmethod
+    def copy_rows(cls, cursor, query, table, timeout=None, max_rows=None):
+        """Execute query directly and copy its rows into the temporary table, raises the errors of executing it."""
+        rows = execute_query(cursor, query, timeout, max_rows)
+        num_columns = len(cursor.description) if cursor.description else 0
+        with temp_tables_allowed(cursor.connection):
+            cls._create_table(cursor, table, num_columns)
+            if rows:
+                cursor.executemany(f"INSERT INTO temp.{table} VALUES ({', '.join('?' * num_columns)})", rows)
+        return cls(cursor, table, num_columns, len(rows))
+
+    def _values(self):
+        return " UNION ALL ".join(f"SELECT c{i} AS v FROM temp.{self.table}" for i in range(self.num_columns))
+
+    def multiset_equal(self, other):
+        if self.num_rows * self.num_columns != other.num_rows * other.num_columns:
+            return False
+        # With equal numbers of values, one direction of EXCEPT is enough
+        self.cursor.execute(f"""SELECT NOT EXISTS (SELECT v, count(*) FROM ({self._values()}) GROUP BY v
+                                                   EXCEPT
+                                                   SELECT v, count(*) FROM ({other._values()}) GROUP BY v)""")
+        return bool(self.cursor.fetchone()[0])
+
+    def exact_equal(self, other):
+        if self.num_rows != other.num_rows:
+            return False
+        if not self.num_rows:
+            return True
+        if self.num_columns != other.num_columns:
+            return False
+        conditions = " AND ".join(f"a.c{i} IS b.c{i}" for i in range(self.num_columns))
+        self.cursor.execute(f"SELECT count(*) FROM temp.{self.table} AS a JOIN temp.{other.table} AS b ON a.rowid = b.rowid AND {conditions}")
+        return self.cursor.fetchone()[0] == self.num_rows
+
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = ResultFingerprint.from_batches(iter_query_batches(self.cursor, f"SELECT * FROM temp.{self.table} ORDER BY rowid"))
+        return self._fingerprint
 
-            error_message = str(e).lower()
-            ignore_errors = ["no such table", "no such column", "ambiguous"]
-            
-            if verbose and not any(ignore in error_message for ignore in ignore_errors):
-                print(f'\nCannot execute {query}\nError: {e}\n{file_name}\n\n')
+    def drop(self):
+        with temp_tables_allowed(self.cursor.connection):
+            self.cursor.execute(f"DROP TABLE IF EXISTS temp.{self.table}")
+
+def compare_materialized_results(predicted_result, gold_result, order_by=False):
+    # An empty prediction never matches
+    if not predicted_result.num_rows:
+        return False
+    if order_by:
+        return predicted_result.fingerprint().ordered == gold_result.fingerprint().ordered
+    return predicted_result.multiset_equal(gold_result)
 
-    if remove_duplicates_predictions:
-        all_pred_exec_outputs = remove_duplicate_results(all_pred_exec_outputs)
+def count_unique_materialized_results(results):
+    unique_results = []
+    has_errors = False
+    for result in results:
+        if isinstance(result, PredQueryExecutionError):
+            has_errors = True
+        elif not any(result.exact_equal(unique_result) for unique_result in unique_results):
+            unique_results.append(result)
+    return len(unique_results) + has_errors
 
-    exec_acc_per_pred_queries = {query: False for query in pred_statements} 
-    for pred_query, pred_exec_output in all_pred_exec_outputs.items():
-        if isinstance(pred_exec_output, PredQueryExecutionError):
+def remove_duplicate_materialized_results(all_pred_exec_outputs):
+    """Same as remove_duplicate_results for results kept in temporary tables (in place)."""
+    kept_results = []
+    keys_to_remove = []
+    for query, result in all_pred_exec_outputs.items():
+        if isinstance(result, PredQueryExecutionError):
             continue
-        for gold_query, gold_exec_output in all_gold_exec_outputs.items():
-            try:
-                if 'order by' in gold_query.lower():
-                    is_same = compare_query_results(pred_exec_output, gold_exec_output, order_by=True)
-                else:
-                    is_same = compare_query_results(pred_exec_output, gold_exec_output, order_by=False)
-                if is_same:
-                    exec_acc_per_gold_queries[gold_query] = True
-                    exec_acc_per_pred_queries[pred_query] = True
-            except Exception as e:
-                raise MetricError(pred_exec_output, gold_exec_output, pred_query, gold_query, e)
-                
-    recall = sum(exec_acc_per_gold_queries.values()) / len(gold_sql_queries)
-    all_found =  sum(exec_acc_per_gold_queries.values()) == len(gold_sql_queries)
-    precision = sum(exec_acc_per_pred_queries.values()) / len(pred_statements) if pred_statements else 0
-    f1_score = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0
-
-    if remove_duplicates_predictions:
-        all_pred_exec_outputs_wo_duplicates = all_pred_exec_outputs
-    else:
-        all_pred_exec_outputs_wo_duplicates = remove_duplicate_results(all_pred_exec_outputs)
-    unique_results = count_unique_results(list(all_pred_exec_outputs.values()))
-    unique_results_filtered = count_unique_results(list(all_pred_exec_outputs_wo_duplicates.values()))
+        
+        if any(compare_materialized_results(kept_result, result, 'order by' in kept_query.lower() or 'order by' in query.lower())
+               for kept_query, kept_result in kept_results):
+            keys_to_remove.append(query)
+        else:
+            kept_results.append((query, result))
+
+    for key in keys_to_remove:
+        del all_pred_exec_outputs[key]
+    
+    return all_pred_exec_outputs
+
+def match_gold_queries(all_pred_exec_outputs, gold_fingerprints):
+    """Gold queries matched by every prediction, using fingerprint lookups."""
+    # Gold queries by the digest they are matched on
+    gold_queries_by_digest = {}
+    for gold_query, gold_fingerprint in gold_fingerprints.items():
+        if 'order by' in gold_query.lower():
+            gold_queries_by_digest.setdefault(('ordered', gold_fingerprint.ordered), []).append(gold_query)
+        else:
+            gold_queries_by_digest.setdefault(('multiset', gold_fingerprint.multiset), []).append(gold_query)
+
+    matches = {}
+    for pred_query, pred_fingerprint in all_pred_exec_outputs.items():
+        # Failed and empty predictions never match
+        if isinstance(pred_fingerprint, PredQueryExecutionError) or not pred_fingerprint.num_rows:
+            continue
+        matches[pred_query] = gold_queries_by_digest.get(('ordered', pred_fingerprint.ordered), []) + \
+                              gold_queries_by_digest.get(('multiset', pred_fingerprint.multiset), [])
+    return matches
+
+def match_gold_queries_in_database(all_pred_exec_outputs, gold_fingerprints, gold_results):
+    """Gold queries matched by every prediction, gold_results holds temporary tables of gold queries without ORDER BY."""
+    matches = {}
+    for pred_query, pred_result in all_pred_exec_outputs.items():
+        if isinstance(pred_result, PredQueryExecutionError) or not pred_result.num_rows:
+            continue
+        matches[pred_query] = []
+        for gold_query, gold_fingerprint in gold_fingerprints.items():
+            if gold_query in gold_results:
+                is_same = pred_result.multiset_equal(gold_results[gold_query])
+            else:
+                is_same = pred_result.fingerprint().ordered == gold_fingerprint.ordered
+            if is_same:
+                matches[pred_query].append(gold_query)
+    return matches
+
+def evaluate_predicted_statements(file_name, pred_statements, gold_sql_queries, remove_duplicates_predictions=False, verbose=False, gold_fingerprints=None,
+                                  query_timeout=None, max_rows=None, in_db_comparison=False):
+    cursor = get_connection(file_name).cursor()
+
+    # Gold results can come precomputed from the gold index
+    if gold_fingerprints is None:
+        gold_fingerprints = gold_fingerprints_of(execute_gold_queries(cursor, gold_sql_queries))
+    exec_acc_per_gold_queries = {query: False for query in gold_fingerprints}
+
+    # Temporary tables created for in-database comparison, dropped at the end
+    materialized_results = []
+    try:
+        all_pred_exec_outputs = {}
+        num_queries = len(pred_statements)
+        pred_statements = list(set(pred_statements))
+        execution_errors = []
+        budget_exceeded = 0
+        # Variants of one query (whitespace, case, aliases...) are executed once and share the result
+        results_by_canonical_query = {}
+        for query in pred_statements:
+            canonical_query = canonicalize_query(query)
+            result = results_by_canonical_query.get(canonical_query)
+            if result is None:
+                try:
+                    if in_db_comparison:
+                        result = MaterializedResult.create(cursor, query, f"pred_result_{len(materialized_results)}", query_timeout, max_rows)
+                        materialized_results.append(result)
+                    else:
+                        result = ResultFingerprint.from_batches(iter_query_batches(cursor, query, query_timeout, max_rows))
+                    results_by_canonical_query[canonical_query] = result
+                except QueryBudgetExceededError as e:
+                    result = results_by_canonical_query[canonical_query] = e
+                except sqlite3.DatabaseError as e:
+                    # Not shared: error messages quote names as the variant writes them
+                    result = PredQueryExecutionError(query, e)
+
+                    error_message = str(e).lower()
+                    ignore_errors = ["no such table", "no such column", "ambiguous"]
+                    
+                    if verbose and not any(ignore in error_message for ignore in ignore_errors):
+                        print(f'\nCannot execute {query}\nError: {e}\n{file_name}\n\n')
+            elif isinstance(result, QueryBudgetExceededError):
+                result = QueryBudgetExceededError(query, result.limit_type, result.limit)
+
+            if isinstance(result, QueryBudgetExceededError):
+                budget_exceeded += 1
+            if isinstance(result, PredQueryExecutionError):
+                execution_errors.append(result.to_dict())
+            all_pred_exec_outputs[query] = result
+
+        if in_db_comparison:
+            remove_duplicates, count_unique = remove_duplicate_materialized_results, count_unique_materialized_results
+        else:
+            remove_duplicates, count_unique = remove_duplicate_results, count_unique_results
+
+        if remove_duplicates_predictions:
+            all_pred_exec_outputs = remove_duplicates(all_pred_exec_outputs)
+
+        if in_db_comparison:
+            gold_results = {}
+            for gold_query in gold_fingerprints:
+                if 'order by' not in gold_query.lower():
+                    gold_results[gold_query] = MaterializedResult.create(cursor, gold_query, f"gold_result_{len(gold_results)}")
+                    materialized_results.append(gold_results[gold_query])
+            matches = match_gold_queries_in_database(all_pred_exec_outputs, gold_fingerprints, gold_results)
+        else:
+            matches = match_gold_queries(all_pred_exec_outputs, gold_fingerprints)
+
+        exec_acc_per_pred_queries = {query: False for query in pred_statements} 
+        for pred_query, matched_gold_queries in matches.items():
+            for gold_query in matched_gold_queries:
+                exec_acc_per_gold_queries[gold_query] = True
+                exec_acc_per_pred_queries[pred_query] = True
+                    
+        recall = sum(exec_acc_per_gold_queries.values()) / len(gold_sql_queries)
+        all_found =  sum(exec_acc_per_gold_queries.values()) == len(gold_sql_queries)
+        precision = sum(exec_acc_per_pred_queries.values()) / len(pred_statements) if pred_statements else 0
+        f1_score = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0
+
+        if remove_duplicates_predictions:
+            all_pred_exec_outputs_wo_duplicates = all_pred_exec_outputs
+        else:
+            all_pred_exec_outputs_wo_duplicates = remove_duplicates(all_pred_exec_outputs)
+        unique_results = count_unique(list(all_pred_exec_outputs.values()))
+        unique_results_filtered = count_unique(list(all_pred_exec_outputs_wo_duplicates.values()))
+    finally:
+        for result in materialized_results:
+            result.drop()
 
     metrics = {
                 'recall': recall,
@@ -174,7 +414,8 @@ def evaluate_predicted_statements(file_name, pred_statements, gold_sql_queries,
                 'unique_results': unique_results,
                 'unique_results_filtered': unique_results_filtered,
                 'execution_errors': execution_errors,
+                'budget_exceeded': budget_exceeded,
                 'all_found': all_found
             }
     
-    return metrics
\ No newline at end of file
+    return metrics
@@ -1,9 +1,15 @@
 import re
-import sqlparse
+
+from sql_splitter import split_statements
+
+STATEMENT_SEPARATOR = re.compile(r';|\n\n')
+NAMED_CODE_BLOCK = re.compile(r"```(\w+)\s+(.*?)```", re.DOTALL)
+CODE_BLOCK = re.compile(r"```(?:\w+)?\s+(.*?)```", re.DOTALL)
+NUMBERING = re.compile(r'\d+\.\s*')
 
 def parse_statements_openchat(text):
     text = text.replace("```sql\n", "").replace("```", "")
-    statements = sqlparse.split(text)
+    statements = split_statements(text)
 
     statements = list(dict.fromkeys(statements))
     if statements:
@@ -15,7 +21,7 @@ def parse_statements_openchat(text):
     new_statements = []
     for code in statements:
         if "\n\n" in code or ";" in code:
-            split = re.split(r';|\n\n', code)
+            split = STATEMENT_SEPARATOR.split(code)
             new_statements += [
                 x.strip() for x in split 
                 if x.strip() and (x.strip().lower().startswith("select") or x.strip().lower().startswith("with"))
@@ -26,11 +32,10 @@ def parse_statements_openchat(text):
 
 def parse_statements_mistral(text):
     if "```" in text:
-        pattern = r"```(\w+)\s+(.*?)```"
-        matches = re.findall(pattern, text, re.DOTALL)
+        matches = NAMED_CODE_BLOCK.findall(text)
         statements = [code for _, code in matches] 
     elif "\n\n" in text or ";" in text:
-        split = re.split(r';|\n\n', text)
+        split = STATEMENT_SEPARATOR.split(text)
         statements = [x.strip() for x in split if x.strip() and x.strip().lower().startswith("select")]
     elif text.strip().lower().startswith("select"):
         statements = [text.strip()]
@@ -48,11 +53,10 @@ def parse_statements_mistral(text):
 
 def parse_statements_mixtral(text):
     if "```" in text:
-        pattern = r"```(\w+)\s+(.*?)```"
-        matches = re.findall(pattern, text, re.DOTALL)
+        matches = NAMED_CODE_BLOCK.findall(text)
         statements = [code for _, code in matches] 
     elif "\n\n" in text or ";" in text:
-        split = re.split(r';|\n\n', text)
+        split = STATEMENT_SEPARATOR.split(text)
         statements = [x.strip() for x in split if x.strip() and (x.strip().lower().startswith("select") or x.strip().lower().startswith("with"))]
     elif text.strip().lower().startswith("select"):
         statements = [text.strip()]
@@ -74,8 +78,7 @@ def parse_single_statement(text):
         text = text[len("assistant\n\n"):].strip()
     
     # Extract code blocks within triple backticks
-    pattern = r"```(?:\w+)?\s+(.*?)```"
-    matches = re.findall(pattern, text, re.DOTALL)
+    matches = CODE_BLOCK.findall(text)
 
     if matches:
         text = "\n\n\n".join(matches)
@@ -83,12 +86,12 @@ def parse_single_statement(text):
     text = '\n'.join([row.strip() for row in text.split('\n')])
     text = text.replace('<step>', '')
 
-    statements = re.split(r'\d+\.\s*', text)
+    statements = NUMBERING.split(text)
     if statements:
         text = "\n\n\n".join(statements)
 
     text = text.replace("```sql\n", "").replace("```", "")
-    statements = sqlparse.split(text)
+    statements = split_statements(text)
     
     statements = list(dict.fromkeys(statements))
     if statements:
@@ -110,8 +113,7 @@ def parse_statements_llama(text):
         text = text[len("assistant\n\n"):].strip()
     
     # Extract code blocks within triple backticks
-    pattern = r"```(?:\w+)?\s+(.*?)```"
-    matches = re.findall(pattern, text, re.DOTALL)
+    matches = CODE_BLOCK.findall(text)
     
     if matches:
         statements = matches  # Directly use the matches list
@@ -122,7 +124,7 @@ def parse_statements_llama(text):
     for code in statements:
         if "\n\n" in code or ";" in code:
             # Split on newlines or semicolons
-            split = re.split(r';|\n\n', code)
+            split = STATEMENT_SEPARATOR.split(code)
             new_statements += [
                 x.strip() for x in split 
                 if x.strip() and (x.strip().lower().startswith("select") or x.strip().lower().startswith("with"))
@@ -154,13 +156,12 @@ def parse_statements_codellama(text):
     if text.lower().startswith("assistant\n\n"):
         text = text[len("assistant\n\n"):].strip()
 
-    statements = re.split(r'\d+\.\s*', text)
+    statements = NUMBERING.split(text)
 
     if not statements:
     
         # Extract code blocks within triple backticks
-        pattern = r"```(?:\w+)?\s+(.*?)```"
-        matches = re.findall(pattern, text, re.DOTALL)
+        matches = CODE_BLOCK.findall(text)
         
         if matches:
             statements = matches  # Directly use the matches list
@@ -171,7 +172,7 @@ def parse_statements_codellama(text):
     for code in statements:
         if "\n\n" in code or ";" in code:
             # Split on newlines or semicolons
-            split = re.split(r';|\n\n', code)
+            split = STATEMENT_SEPARATOR.split(code)
             new_statements += [
                 x.strip() for x in split 
                 if x.strip() and (x.strip().lower().startswith("select") or x.strip().lower().startswith("with"))
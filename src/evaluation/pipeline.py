@@ -0,0 +1,134 @@
+import time
+import queue
+import threading
+import contextlib
+import multiprocessing
+import concurrent.futures
+
+import db_connections
+from gold_index import GoldIndex
+from evaluation_utils import generate, parse_outputs, score_statements, TOKEN_COUNT_COLUMNS
+from prefix_scheduler import schedule_by_prefix
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.first_start = None
+        self.last_end = None
+        self.lock = threading.Lock()
+
+    def record(self, started, finished):
+        with self.lock:
+            self.items += 1
+            self.busy_seconds += finished - started
+            self.first_start = started if self.first_start is None else min(self.first_start, started)
+            self.last_end = finished if self.last_end is None else max(self.last_end, finished)
+
+    def to_dict(self):
+        wall_seconds = self.last_end - self.first_start if self.items else 0.0
+        return {
+            'items': self.items,
+            'busy_seconds': self.busy_seconds,
+            'wall_seconds': wall_seconds,
+            'items_per_second': self.items / wall_seconds if wall_seconds > 0 else None
+        }
+
+# Execution workers are separate processes, each opens its own connections and gold index
+_worker_gold_index = None
+
+def _init_execution_worker(in_memory_db, gold_index_file):
+    global _worker_gold_index
+    db_connections.configure(in_memory=in_memory_db)
+    if gold_index_file:
+        _worker_gold_index = GoldIndex(gold_index_file)
+
+def _execute_and_score(args, example, statements):
+    started = time.monotonic()
+    scored = score_statements(args, example, statements, _worker_gold_index)
+    return example, scored, started, time.monotonic()
+
+def run_pipeline(eval_config, df):
+    """Generate, parse and score all questions of df with overlapping stages, returns the statistics of the stages.
+
+    Generation runs in a thread pool and feeds a queue consumed by the parsing stage in the calling thread,
+    which submits parsed statements to a process pool for execution and scoring.
+    """
+    args = eval_config.args
+    stats = {name: StageStats(name) for name in ['generation', 'parsing', 'execution']}
+    parse_queue = queue.Queue()
+
+    def generate_one(idx, example, prompt):
+        started = time.monotonic()
+        try:
+            if eval_config.precomputed_outputs is not None:
+                outputs = eval_config.precomputed_outputs[idx]
+            else:
+                outputs = generate(args, eval_config.generator, prompt, eval_config.cache, eval_config.concurrency, eval_config.early_stopper)
+        except Exception as e:
+            parse_queue.put((example, None, e))
+            return
+        stats['generation'].record(started, time.monotonic())
+        parse_queue.put((example, outputs, None))
+
+    def collect(example, scored):
+        # Called from the parsing stage and from callbacks of the execution pool, the stream has its own lock
+        if eval_config.results_stream is not None:
+            eval_config.results_stream.write(example, scored[1] if scored is not None else None)
+
+    examples = {idx: row.to_dict() for idx, row in df.iterrows()}
+    if eval_config.precomputed_outputs is not None:
+        requests = [(idx, None) for idx in examples]
+    else:
+        requests = [(idx, eval_config.prompt_assembler.format(example['db_dump'], example['question']))
+                    for idx, example in examples.items()]
+        if args.prefix_scheduling:
+            requests, eval_config.prefix_schedule = schedule_by_prefix(requests)
+
+    def executed(future):
+        # Runs as soon as a question is scored, so that its result reaches the stream even if the run fails later
+        if future.exception() is not None:
+            return
+        example, scored, started, finished = future.result()
+        stats['execution'].record(started, finished)
+        collect(example, scored)
+
+    execution_futures = []
+    if args.ambig_detection:
+        # Detection answers are scored in the parsing stage without executing SQL, no worker processes are needed
+        execution_executor = contextlib.nullcontext()
+    else:
+        execution_executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.num_execution_workers,
+                                                                    # Generation threads are already running, do not fork them
+                                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                                    initializer=_init_execution_worker,
+                                                                    initargs=(args.in_memory_db, args.gold_index))
+    # With adaptive concurrency, the controller limits requests in flight instead of the number of threads
+    num_generation_workers = args.max_concurrency if eval_config.concurrency is not None else args.num_generation_workers
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_generation_workers) as generation_executor, execution_executor:
+        for idx, prompt in requests:
+            generation_executor.submit(generate_one, idx, examples[idx], prompt)
+
+        for _ in range(len(df)):
+            example, outputs, error = parse_queue.get()
+            if error is not None:
+                generation_executor.shutdown(cancel_futures=True)
+                raise error
+
+            started = time.monotonic()
+            statements = parse_outputs(eval_config, outputs)
+            if args.ambig_detection:
+                collect(example, score_statements(args, example, statements))
+            else:
+                # Only the fields used for scoring are sent to the execution workers
+                example = {key: example[key] for key in ['question', 'db_file', 'gold_queries', 'ambig_type'] + TOKEN_COUNT_COLUMNS if key in example}
+                execution_futures.append(execution_executor.submit(_execute_and_score, args, example, statements))
+                execution_futures[-1].add_done_callback(executed)
+            stats['parsing'].record(started, time.monotonic())
+
+    # Errors of execution workers
+    for future in execution_futures:
+        future.result()
+
+    return {name: stage_stats.to_dict() for name, stage_stats in stats.items()}
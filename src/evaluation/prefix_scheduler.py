@@ -0,0 +1,35 @@
+def shared_prefix_length(a, b):
+    # Binary search over slice comparisons, which run in C, instead of comparing characters one by one
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def prefix_hit_ratio(prompts):
+    """Estimated share of prompt characters a server prefix cache can reuse when prompts arrive in this order.
+
+    Every prompt is counted as reusing the prefix it shares with the previous prompt.
+    """
+    total = sum(len(prompt) for prompt in prompts)
+    if not total:
+        return 0.0
+    reused = sum(shared_prefix_length(previous, prompt) for previous, prompt in zip(prompts, prompts[1:]))
+    return reused / total
+
+def schedule_by_prefix(requests):
+    """Order (key, prompt) requests so that prompts with the same ICL block and database dump are sent back to back.
+
+    Returns the ordered requests and the estimated prefix hit ratio before and after ordering.
+    """
+    # In lexicographic order, prompts with the longest shared prefixes are neighbours
+    scheduled = sorted(requests, key=lambda request: request[1])
+    stats = {
+        'requests': len(requests),
+        'prefix_hit_ratio': prefix_hit_ratio([prompt for _, prompt in scheduled]),
+        'unscheduled_prefix_hit_ratio': prefix_hit_ratio([prompt for _, prompt in requests])
+    }
+    return scheduled, stats
@@ -0,0 +1,118 @@
+import numpy as np
+
+def load_token_counter(args, tokenizer=None):
+    if tokenizer is None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name, cache_dir=args.transformers_cache)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+def split_insert_values(values):
+    """Split "(1,'a'),(2,'b')" into rows, None if string literals or parentheses are not balanced."""
+    rows, depth, start, in_string = [], 0, 0, False
+    for i, ch in enumerate(values):
+        if in_string:
+            # An escaped quote '' closes and reopens the literal
+            if ch == "'":
+                in_string = False
+        elif ch == "'":
+            in_string = True
+        elif ch == '(':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+            if depth == 0:
+                rows.append(values[start:i + 1])
+    if in_string or depth != 0:
+        return None
+    return rows
+
+def parse_dump_rows(db_dump):
+    """Lines of a merged dump, INSERT statements are replaced by (statement head, rows)."""
+    lines = []
+    for line in db_dump.split('\n'):
+        if line.startswith("INSERT INTO ") and ") VALUES " in line and line.endswith(";"):
+            head, _, values = line.partition(") VALUES ")
+            rows = split_insert_values(values[:-1])
+            if rows is not None:
+                lines.append((head + ") VALUES ", rows))
+                continue
+        lines.append(line)
+    return lines
+
+def render_dump(lines, max_rows=None):
+    """Dump from parse_dump_rows with at most max_rows rows per table, tables without rows lose their INSERT statement."""
+    rendered = []
+    for line in lines:
+        if isinstance(line, tuple):
+            head, rows = line
+            rows = rows if max_rows is None else rows[:max_rows]
+            if rows:
+                rendered.append(head + ",".join(rows) + ";")
+        else:
+            rendered.append(line)
+    return "\n".join(rendered)
+
+def fit_db_dump(db_dump, budget, count_tokens):
+    """Keep the largest number of rows per table for which the dump has at most budget tokens.
+
+    Returns the dump with its token count before and after compaction. Without any rows, the schema alone may still exceed the budget.
+    """
+    tokens = count_tokens(db_dump)
+    if tokens <= budget:
+        return db_dump, tokens, tokens
+
+    lines = parse_dump_rows(db_dump)
+    lo, hi = 0, max([len(line[1]) for line in lines if isinstance(line, tuple)], default=0)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(render_dump(lines, mid)) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    compacted = render_dump(lines, lo)
+    return compacted, tokens, count_tokens(compacted)
+
+def prompt_length_histogram(prompt_tokens, num_bins=10):
+    counts, bin_edges = np.histogram(prompt_tokens, bins=num_bins)
+    return {'bin_edges': bin_edges.tolist(), 'counts': counts.tolist()}
+
+def apply_token_budget(eval_config, df, count_tokens):
+    """Compact dumps to args.dump_token_budget and drop questions whose prompt exceeds args.max_prompt_tokens.
+
+    Runs before any request is sent. Token counts are added as columns and stored with the results.
+    Returns the remaining questions and statistics of prompt lengths.
+    """
+    args = eval_config.args
+    df = df.copy()
+
+    if args.dump_token_budget:
+        compacted_dumps = {}
+        for db_file, db_dump in zip(df['db_file'], df['db_dump']):
+            if db_file not in compacted_dumps:
+                compacted_dumps[db_file] = fit_db_dump(db_dump, args.dump_token_budget, count_tokens)
+        df['db_dump'] = df['db_file'].map(lambda db_file: compacted_dumps[db_file][0])
+        df['dump_tokens'] = df['db_file'].map(lambda db_file: compacted_dumps[db_file][1])
+        df['compacted_dump_tokens'] = df['db_file'].map(lambda db_file: compacted_dumps[db_file][2])
+
+    df['prompt_tokens'] = [count_tokens(eval_config.prompt_assembler.format(db_dump, question))
+                           for db_dump, question in zip(df['db_dump'], df['question'])]
+
+    stats = {
+        'histogram': prompt_length_histogram(df['prompt_tokens']) if len(df) else None,
+        'max': int(df['prompt_tokens'].max()) if len(df) else 0,
+        'mean': float(df['prompt_tokens'].mean()) if len(df) else 0.0,
+        'rejected': 0
+    }
+    if args.dump_token_budget:
+        stats['compacted_databases'] = sum(before != after for _, before, after in compacted_dumps.values())
+
+    if args.max_prompt_tokens:
+        too_long = df['prompt_tokens'] > args.max_prompt_tokens
+        stats['rejected'] = int(too_long.sum())
+        stats['rejected_questions'] = df.loc[too_long, 'question'].tolist()
+        df = df[~too_long]
+
+    return df, stats
@@ -0,0 +1,46 @@
+import os
+import json
+import threading
+
+def read_results_stream(stream_file):
+    """Records of a results stream, a last line cut off by a crash is ignored."""
+    if not os.path.exists(stream_file):
+        return
+    with open(stream_file, 'r') as f:
+        for line in f:
+            if line.endswith("\n"):
+                yield json.loads(line)
+
+def completed_keys(stream_file, seed):
+    return {(record['question'], record['db_file']) for record in read_results_stream(stream_file) if record['seed'] == seed}
+
+class ResultsStream:
+    """Results appended to a JSONL file as soon as each question is scored, questions without result are stored with None."""
+    def __init__(self, stream_file, seed, resume=False):
+        self.seed = seed
+        self.lock = threading.Lock()
+
+        if resume and os.path.exists(stream_file):
+            # Drop a line cut off by a crash so that new records start on their own line
+            with open(stream_file, 'rb+') as f:
+                content = f.read()
+                f.truncate(content.rfind(b"\n") + 1)
+            self.f = open(stream_file, 'a')
+        else:
+            self.f = open(stream_file, 'w')
+
+    def write(self, example, result):
+        record = {
+            'question': example['question'],
+            'db_file': example['db_file'],
+            'ambig_type': example['ambig_type'],
+            'seed': self.seed,
+            'result': result
+        }
+        line = json.dumps(record)
+        with self.lock:
+            self.f.write(line + "\n")
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
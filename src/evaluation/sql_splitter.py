@@ -0,0 +1,174 @@
+import re
+
+import sqlparse
+from sqlparse import keywords, tokens as T
+from sqlparse.lexer import Lexer
+from sqlparse.engine.statement_splitter import StatementSplitter
+
+# The lexer and the splitting loop follow the internals of this sqlparse release (pinned in the Dockerfiles),
+# with any other release the statements are split by sqlparse.split itself
+SQLPARSE_VERSION = "0.6.0"
+SUPPORTED = sqlparse.__version__ == SQLPARSE_VERSION and hasattr(keywords, 'find_delimited_spans')
+
+# Quoted strings and names matched by runs of characters instead of one character per loop, with the same matches.
+# A run is taken whole, emulating an atomic group with a lookahead and a backreference, so failed matches stay linear.
+_FASTER_REGEXES = {
+    r"'(''|\\'|[^'])*'": r"'(?:(?=(?P<single_run>[^'\\]+))(?P=single_run)|''|\\'|\\)*'",
+    r'"(""|\\"|[^"])*"': r'"(?:(?=(?P<double_run>[^"\\]+))(?P=double_run)|""|\\"|\\)*"',
+    r"`(``|[^`])*`": r"`(?:(?=(?P<backtick_run>[^`]+))(?P=backtick_run)|``)*`",
+}
+
+# sqlparse tries its token regexes one by one at every position, the first one that matches wins.
+# One alternation of the same regexes picks the same token in a single match call.
+if SUPPORTED:
+    _TOKEN_REGEX = re.compile('|'.join(f"(?P<t{i}>{_FASTER_REGEXES.get(regex, regex)})" for i, (regex, _) in enumerate(keywords.SQL_REGEX)),
+                              re.IGNORECASE | re.UNICODE)
+    _TOKEN_ACTIONS = {f"t{i}": action for i, (_, action) in enumerate(keywords.SQL_REGEX)}
+    _KEYWORD_REGEX_WORDS = {word for regex, _ in keywords.SQL_REGEX for word in re.findall(r"[A-Z]{2,}", regex)}
+_KEYWORD_TYPES = {}
+
+# Fast path for the most common tokens, taken only where no earlier regex of sqlparse can match:
+# runs of spaces, single punctuation and words that no keyword regex starts with and that are not names before '.' or '('
+_SIMPLE_TOKEN = re.compile(r"(?P<space>[^\S\r\n]+)|(?P<punctuation>[;(),])|(?P<word>(?!\d)(?P<run>\w+)[$#\w]*)")
+_NAME_FOLLOWS = re.compile(r"\s*\.(?!\d)|\(")
+
+# Statements end at the first token after the semicolon that is not one of these, as in sqlparse
+_END_OF_STATEMENT_TYPES = (T.Whitespace, T.Comment.Single)
+# An opener of these without a closer yet lexes as an error token, later text may close it
+_QUOTES = "'\"`´"
+_BRACKET_OPENER = re.compile(r'(?<![\w\])])\[')
+_BRACKETS = re.compile(r'[\[\]]')
+# Words, dots and whitespace at the end of the text can lex differently with more text: 'GO' is a keyword,
+# 'GO .' a name followed by a dot, 'ORDER' and 'ORDER BY' are different keywords
+_MERGEABLE = re.compile(r'[\s\w.]')
+
+def _keyword_type(value):
+    ttype = _KEYWORD_TYPES.get(value)
+    if ttype is None:
+        ttype = _KEYWORD_TYPES[value] = Lexer.get_default_instance().is_keyword(value)[0]
+    return ttype
+
+def _mergeable_tail(text, pos):
+    """Start of the words, dots and whitespace that end text from pos."""
+    start = len(text)
+    while start > pos and _MERGEABLE.match(text, start - 1):
+        start -= 1
+    return start
+
+def _tokens(text, pos):
+    """(start, end, token type, unresolved) of the tokens of text from pos, unresolved tokens could change with more text."""
+    # Only the text from pos is scanned for delimiters, with one more character for the lookbehind of dollar quote openers
+    offset = max(pos - 1, 0)
+    spans = keywords.find_delimited_spans(text[offset:])
+    tail = _mergeable_tail(text, pos)
+    while pos < len(text):
+        unresolved = False
+        if pos - offset in spans.openers:
+            resolved = spans.resolve(pos - offset)
+            if resolved is not None:
+                end, ttype = resolved
+                yield pos, end + offset, ttype, False
+                pos = end + offset
+                continue
+            unresolved = True
+
+        m = _SIMPLE_TOKEN.match(text, pos)
+        if m is not None and not unresolved:
+            if m.lastgroup == 'space':
+                yield pos, m.end(), T.Whitespace, False
+                pos = m.end()
+                continue
+            if m.lastgroup == 'punctuation':
+                yield pos, m.end(), T.Punctuation, False
+                pos = m.end()
+                continue
+            if m.group('run').upper() not in _KEYWORD_REGEX_WORDS and text[pos - 1:pos] != '.' \
+                    and not _NAME_FOLLOWS.match(text, m.end('run')):
+                yield pos, m.end(), _keyword_type(m.group()), pos >= tail
+                pos = m.end()
+                continue
+
+        m = _TOKEN_REGEX.match(text, pos)
+        if m is None:
+            yield pos, pos + 1, T.Error, unresolved or text[pos] in _QUOTES
+            pos += 1
+            continue
+        action = _TOKEN_ACTIONS[m.lastgroup]
+        ttype = _keyword_type(m.group()) if action is keywords.PROCESS_AS_KEYWORD else action
+        if text[pos] == '[' and ttype is T.Punctuation and _BRACKET_OPENER.match(text, pos) and not _BRACKETS.search(text, pos + 1):
+            unresolved = True
+        # A string closed by an escaped quote (backslash) only ends there because no later quote exists yet
+        if ttype in T.String and m.end() - pos > 2 and text[m.end() - 2] == '\\':
+            unresolved = True
+        yield pos, m.end(), ttype, unresolved or pos >= tail
+        pos = m.end()
+
+def _split(text, pos):
+    """Statements of text from pos as (start, end) pairs and the first position that later text could change."""
+    statements = []
+    unresolved_at = None
+    splitter = StatementSplitter()
+    start = pos
+    for token_start, token_end, ttype, unresolved in _tokens(text, pos):
+        if unresolved and unresolved_at is None:
+            unresolved_at = token_start
+        value = text[token_start:token_end]
+
+        # Same steps as sqlparse's StatementSplitter.process, on positions instead of token objects
+        if splitter.consume_ws and ttype not in _END_OF_STATEMENT_TYPES:
+            statements.append((start, token_start))
+            splitter._reset()
+            start = token_start
+
+        if ttype in T.Keyword or ttype is T.Punctuation:
+            splitter.level += splitter._change_splitlevel(ttype, value)
+
+        if ttype is T.Punctuation and value == ';':
+            splitter._seen_begin = False
+            if splitter.level <= 0 and 'BEGIN' not in splitter._block_stack:
+                splitter.consume_ws = True
+        elif ttype is T.Keyword and value.split()[0] == 'GO':
+            splitter.consume_ws = True
+        elif ttype not in (T.Whitespace, T.Newline, T.Comment.Single, T.Comment.Multiline) \
+                and not (ttype is T.Keyword and value.upper() == 'BEGIN'):
+            splitter._seen_begin = False
+
+    # sqlparse drops a last statement made only of whitespace tokens
+    if text[start:].strip():
+        statements.append((start, len(text)))
+    return statements, unresolved_at
+
+def split_statements(text):
+    """Same result as sqlparse.split(text)."""
+    if not SUPPORTED:
+        return sqlparse.split(text)
+    statements, _ = _split(text, 0)
+    return [text[start:end].strip() for start, end in statements]
+
+class IncrementalSplitter:
+    """Splits text fed in chunks, statements() is always sqlparse.split() of the text fed so far.
+
+    Statements that later text cannot change are kept, so only the text after them is lexed again.
+    """
+    def __init__(self):
+        self.text = ""
+        self.done = []
+        self.start = 0
+
+    def feed(self, chunk):
+        self.text += chunk
+
+    def statements(self):
+        if not SUPPORTED:
+            return sqlparse.split(self.text)
+        statements, unresolved_at = _split(self.text, self.start)
+        pending = []
+        for start, end in statements:
+            # The token starting the next statement decides where this one ends, two characters fix its type ('-' or '--')
+            final = not pending and end + 2 <= len(self.text) and (unresolved_at is None or unresolved_at >= end)
+            if final:
+                self.done.append(self.text[start:end].strip())
+                self.start = end
+            else:
+                pending.append(self.text[start:end].strip())
+        return self.done + pending
@@ -0,0 +1,95 @@
+import threading
+
+# Statements can only be completed by tokens containing one of these characters, parsing is retried only after them
+BOUNDARY_CHARACTERS = ("\n", ";", "`")
+
+class StreamedCompletion:
+    """Text of one streamed completion, complete once its parsed statements stay the same for patience tokens."""
+    def __init__(self, parse_statements, patience):
+        self.parse_statements = parse_statements
+        self.patience = patience
+        self.text = ""
+        self.num_tokens = 0
+        self.statements = None
+        self.changed_at = 0
+
+    def add(self, output):
+        """Add one stream output of TGI, returns True if the rest of the completion can be dropped."""
+        self.num_tokens += 1
+        if output.generated_text is not None:
+            # The last output carries the whole text as the server decodes it
+            self.text = output.generated_text
+            return False
+        if output.token.special:
+            return False
+        self.text += output.token.text
+        if not any(character in output.token.text for character in BOUNDARY_CHARACTERS):
+            return False
+        # Nothing to parse before the first query, parsers also complain about such text
+        if 'select' not in self.text.lower():
+            return False
+
+        statements = self.parse_statements(self.text)
+        if statements != self.statements:
+            self.statements = statements
+            self.changed_at = self.num_tokens
+            return False
+        return bool(statements) and self.num_tokens - self.changed_at >= self.patience
+
+class EarlyStopper:
+    """Streams TGI completions and cancels them once the model-specific parser sees a completed answer."""
+    def __init__(self, parse_statements, patience, max_new_tokens):
+        self.parse_statements = parse_statements
+        self.patience = patience
+        self.max_new_tokens = max_new_tokens
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.early_stops = 0
+        self.generated_tokens = 0
+        self.tokens_saved = 0
+
+    def _record(self, completion, stopped):
+        with self.lock:
+            self.requests += 1
+            self.generated_tokens += completion.num_tokens
+            if stopped:
+                self.early_stops += 1
+                # Upper bound: the model might have ended the completion before max_new_tokens on its own
+                self.tokens_saved += self.max_new_tokens - completion.num_tokens
+
+    def generate(self, generator, request):
+        completion = StreamedCompletion(self.parse_statements, self.patience)
+        stream = generator.text_generation(**request, stream=True, details=True)
+        stopped = False
+        try:
+            for output in stream:
+                if completion.add(output):
+                    stopped = True
+                    break
+        finally:
+            # Closing the stream drops the connection, which makes TGI stop generating
+            stream.close()
+        self._record(completion, stopped)
+        return completion.text
+
+    async def agenerate(self, generator, request):
+        completion = StreamedCompletion(self.parse_statements, self.patience)
+        stream = await generator.text_generation(**request, stream=True, details=True)
+        stopped = False
+        try:
+            async for output in stream:
+                if completion.add(output):
+                    stopped = True
+                    break
+        finally:
+            await stream.aclose()
+        self._record(completion, stopped)
+        return completion.text
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'early_stops': self.early_stops,
+            'generated_tokens': self.generated_tokens,
+            'tokens_saved': self.tokens_saved
+        }
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import concurrent.futures
+from types import SimpleNamespace
+
+# A batch is sent when it is full or this long after its first prompt
+MAX_WAIT_SECONDS = 0.05
+
+def fan_out(response, num_prompts, n):
+    """Split the choices of a completions request with a list of prompts into one response per prompt."""
+    choices = sorted(response.choices, key=lambda choice: choice.index)
+    return [SimpleNamespace(choices=[choice for choice in choices if choice.index // n == i]) for i in range(num_prompts)]
+
+class BatchedCompletionsClient:
+    """vLLM client whose completions.create coalesces the prompts of concurrent calls into one request.
+
+    Calls have to differ only in the prompt, as all calls of one evaluation run do.
+    """
+    def __init__(self, client, max_batch_size, is_async=False, max_wait=MAX_WAIT_SECONDS):
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.condition = threading.Condition()
+        self.async_condition = None
+        self.completions = SimpleNamespace(create=self.acreate if is_async else self.create)
+
+    def _join(self, request, future):
+        """Add a call to the pending batch, returns the batch and whether this call sends it."""
+        batch = self.pending
+        batch.append((request, future))
+        if len(batch) >= self.max_batch_size:
+            self.pending = []
+        return batch, len(batch) == 1
+
+    def _take(self, batch):
+        if self.pending is batch:
+            self.pending = []
+        request = dict(batch[0][0], prompt=[request['prompt'] for request, _ in batch])
+        return request, [future for _, future in batch]
+
+    def _resolve(self, futures, request, response=None, error=None):
+        if error is not None:
+            for future in futures:
+                future.set_exception(error)
+            return
+        for future, prompt_response in zip(futures, fan_out(response, len(futures), request.get('n', 1))):
+            future.set_result(prompt_response)
+
+    def create(self, **request):
+        future = concurrent.futures.Future()
+        with self.condition:
+            batch, is_leader = self._join(request, future)
+            self.condition.notify_all()
+            if is_leader:
+                self.condition.wait_for(lambda: self.pending is not batch, timeout=self.max_wait)
+                batch_request, futures = self._take(batch)
+        if is_leader:
+            try:
+                response = self.client.completions.create(**batch_request)
+            except Exception as e:
+                self._resolve(futures, batch_request, error=e)
+            else:
+                self._resolve(futures, batch_request, response)
+        return future.result()
+
+    async def acreate(self, **request):
+        # Used from a single event loop, like AdaptiveConcurrency.aslot
+        if self.async_condition is None:
+            self.async_condition = asyncio.Condition()
+        future = asyncio.get_running_loop().create_future()
+        async with self.async_condition:
+            batch, is_leader = self._join(request, future)
+            self.async_condition.notify_all()
+            if is_leader:
+                try:
+                    await asyncio.wait_for(self.async_condition.wait_for(lambda: self.pending is not batch), self.max_wait)
+                except asyncio.TimeoutError:
+                    pass
+                batch_request, futures = self._take(batch)
+        if is_leader:
+            try:
+                response = await self.client.completions.create(**batch_request)
+            except Exception as e:
+                self._resolve(futures, batch_request, error=e)
+            else:
+                self._resolve(futures, batch_request, response)
+        return await future
+
+def batched_completions_client(args, client, is_async=False):
+    if args.vllm_batch_size > 1:
+        return BatchedCompletionsClient(client, args.vllm_batch_size, is_async)
+    return client